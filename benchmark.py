@@ -0,0 +1,341 @@
+#
+# Copyright(c) 2023 Leiden University, Faculty of Sciences - LIACS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors:
+#
+#   Richard M.K. van Dijk
+#   Research sofware engineer
+#   E: m.k.van.dijk@liacs.leidenuniv.nl
+#
+#   Anton Schreuder
+#   Postdoctoral researcher
+#   E: a.schreuder@liacs.leidenuniv.nl
+#
+#   Leiden University,
+#   Faculty of Math and Natural Sciences,
+#   Leiden Institute of Advanced Computer Science (LIACS)
+#   Snellius building | Niels Bohrweg 1 | 2333 CA Leiden
+#   The Netherlands
+#
+
+
+import os
+import json
+import time
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+import pyreadstat as sav
+import files as fs
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine, event
+import database as db
+
+#
+# Package startup code
+#
+global BENCHMARK_FOLDER
+BENCHMARK_FOLDER = tempfile.gettempdir()  # Folder of the generated synthetic sav files
+
+# The fractions of the columns of each type in the synthetic files of the conversion benchmark
+TYPE_MIX = dict(code=0.5, amount=0.2, string=0.2, date=0.1)
+
+# The conversion routes of the conversion benchmark
+ROUTES = ['chunks', 'whole', 'csv']
+
+#
+# Functions
+#
+
+# Write a synthetic sav file with nrRows rows and nrColumns numeric code columns,
+#   rowCompress writes a bytecode compressed file like most CBS files (pyreadstat >= 1.2.1)
+def createSyntheticSavFile(file, nrRows, nrColumns=10, rowCompress=False):
+    rng = np.random.default_rng(0)
+    data = {"RINPERSOON": np.arange(nrRows, dtype=np.float64)}
+    for column in range(nrColumns - 1):
+        data[f"CODE{column}"] = rng.integers(0, 100, nrRows).astype(np.float64)
+    if rowCompress:
+        sav.write_sav(pd.DataFrame(data), file, row_compress=True)
+    else:
+        sav.write_sav(pd.DataFrame(data), file)
+    return
+
+# Time the reading of each chunk, with a list of seconds per chunk as result
+def timeChunksOfSavFile(chunks):
+    seconds = []
+    begin = time.perf_counter()
+    for df, meta in chunks:
+        end = time.perf_counter()
+        seconds.append(end - begin)
+        begin = end
+    return seconds
+
+# Read the whole sav file in one read_sav call, the single pass the chunks are compared with
+def readSavFileAtOnce(file):
+    df, meta = sav.read_sav(file)
+    yield df, meta
+    return
+
+#
+# Measure the cost of reading a sav file in chunks for growing files, uncompressed and row compressed.
+# fs.readChunksOfSavFile makes one read_sav call per chunk, which parses the dictionary again and skips
+# the rows before its offset. For uncompressed files that is a seek and the time per chunk stays about
+# constant. For row compressed files, most CBS files, readstat decompresses all skipped rows, so the time
+# per chunk grows with the offset and the total with the square of the rows: the growth is the time of the
+# last chunk over the first, the overhead the total time of the chunks over one read of the whole file.
+#
+def benchmarkChunksOfSavFile(nrRowsList=(200000, 400000, 800000), chunksize=50000, nrColumns=10, compressions=(False, True)):
+
+    print(f"{'rows':>10} {'compressed':>10} {'chunks':>7} {'first (s)':>10} {'last (s)':>10} {'growth':>7} {'total (s)':>10} {'at once (s)':>12} {'overhead':>9}")
+
+    for nrRows in nrRowsList:
+        for rowCompress in compressions:
+            file = os.path.join(BENCHMARK_FOLDER, f"benchmark_{nrRows}.sav")
+            try:
+                createSyntheticSavFile(file, nrRows, nrColumns, rowCompress)
+            except TypeError:
+                print(f"{nrRows:>10} {str(rowCompress):>10} row compressed files need pyreadstat >= 1.2.1, skipped")
+                continue
+
+            seconds = timeChunksOfSavFile(fs.readChunksOfSavFile(file, chunksize))
+            atOnce = sum(timeChunksOfSavFile(readSavFileAtOnce(file)))
+            print(f"{nrRows:>10} {str(rowCompress):>10} {len(seconds):>7} {seconds[0]:>10.4f} {seconds[-1]:>10.4f} "
+                  f"{seconds[-1] / seconds[0]:>7.1f} {sum(seconds):>10.3f} {atOnce:>12.3f} {sum(seconds) / atOnce:>9.1f}")
+
+            os.remove(file)
+
+    return
+
+# Write a synthetic csv file with nrRows rows and nrColumns columns of codes, amounts, dates and strings
+def createSyntheticCsvFile(file, nrRows, nrColumns=10, delimiter=';'):
+    rng = np.random.default_rng(0)
+    data = {"RINPERSOON": [f"{value:09d}" for value in range(nrRows)]}
+    for column in range(nrColumns - 1):
+        if column % 4 == 0:
+            data[f"CODE{column}"] = rng.integers(0, 100, nrRows)
+        elif column % 4 == 1:
+            data[f"AMOUNT{column}"] = rng.random(nrRows) * 1000
+        elif column % 4 == 2:
+            data[f"DATE{column}"] = pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 7000, nrRows), unit="D")
+        else:
+            data[f"NAME{column}"] = np.where(rng.random(nrRows) < 0.5, "ja; zeker", "nee")
+    pd.DataFrame(data).to_csv(file, sep=delimiter, index=False, date_format="%Y-%m-%d")
+    return
+
+#
+# Compare sniffing a csv file from one sample with the dialect detection of the python engine, for a wide and a
+# long file. The sniffing time should not grow with the length of the file, the chunks are parsed by the C engine.
+#
+def benchmarkCsvSniffing(shapes=((2000, 1000), (2000000, 10))):
+
+    print(f"{'rows':>10} {'columns':>8} {'size (MB)':>10} {'sniff (s)':>10} {'python (s)':>11} {'parse (s)':>10} {'MB/s':>8}")
+
+    for nrRows, nrColumns in shapes:
+        file = os.path.join(BENCHMARK_FOLDER, f"benchmark_{nrRows}x{nrColumns}.csv")
+        createSyntheticCsvFile(file, nrRows, nrColumns)
+        size = os.stat(file).st_size / 1000000
+
+        fs.sniffedCsvFiles.clear()
+        begin = time.perf_counter()
+        csvFile = fs.sniffCsvFile(file)
+        sniffSeconds = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        pd.read_csv(file, sep=None, engine='python', nrows=csvFile.sampledRows)
+        pythonSeconds = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        for df, byteEnd in fs.readChunksOfCsvFile(file):
+            pass
+        parseSeconds = time.perf_counter() - begin
+
+        print(f"{nrRows:>10} {nrColumns:>8} {size:>10.1f} {sniffSeconds:>10.4f} {pythonSeconds:>11.4f} {parseSeconds:>10.4f} {size/parseSeconds:>8.1f}")
+
+        os.remove(file)
+
+    return
+
+#
+# Conversion benchmark
+#
+#   Converts synthetic sav files, and a csv file of the same data, into a SQLite database with the
+#   conversion functions of database.py. Each conversion runs in a new process, to measure its peak memory.
+#
+
+# A synthetic data frame with nrRows rows and nrColumns columns of the types in typeMix
+def createSyntheticDataFrame(nrRows, nrColumns=20, typeMix=TYPE_MIX):
+    rng = np.random.default_rng(0)
+    data = {"RINPERSOON": np.arange(nrRows, dtype=np.float64)}
+
+    columnTypes = []
+    for columnType, fraction in typeMix.items():
+        columnTypes += [columnType] * int(round(fraction * (nrColumns - 1)))
+
+    for column, columnType in enumerate(columnTypes):
+        if columnType == 'code':
+            data[f"CODE{column}"] = rng.integers(0, 100, nrRows).astype(np.float64)
+        elif columnType == 'amount':
+            data[f"AMOUNT{column}"] = np.round(rng.random(nrRows) * 100000, 2)
+        elif columnType == 'string':
+            data[f"NAME{column}"] = np.array(["gemeente", "provincie", "land", "wijk"])[rng.integers(0, 4, nrRows)]
+        else:
+            data[f"DATE{column}"] = pd.Timestamp("1950-01-01") + pd.to_timedelta(rng.integers(0, 25000, nrRows), unit="D")
+
+    return pd.DataFrame(data)
+
+# Write the synthetic data frame to a sav file, and to a csv file if given
+def createMixedSavFile(file, nrRows, nrColumns=20, typeMix=TYPE_MIX, csvFile=None):
+    df = createSyntheticDataFrame(nrRows, nrColumns, typeMix)
+    dateColumns = [column for column in df.columns if column.startswith("DATE")]
+    sav.write_sav(df, file, variable_format={column: "DATE11" for column in dateColumns})
+    if csvFile is not None:
+        df.to_csv(csvFile, index=False, date_format="%Y-%m-%d")
+    return
+
+def removeBenchmarkDatabase(folder, name):
+    for file in [os.path.join(folder, f"{name}.db"), os.path.join(folder, f"{name}_dbo.db")]:
+        if os.path.exists(file):
+            os.remove(file)
+    return
+
+# A SQLite engine on a file in folder, with the schema dbo attached like the tables of SQL Server
+def createBenchmarkEngine(folder, name):
+    databaseFile = os.path.join(folder, f"{name}.db")
+    schemaFile = os.path.join(folder, f"{name}_dbo.db")
+    removeBenchmarkDatabase(folder, name)
+
+    engine = create_engine(f"sqlite:///{databaseFile}")
+
+    @event.listens_for(engine, "connect")
+    def attachSchema(connection, record):
+        connection.execute(f"ATTACH DATABASE '{schemaFile}' AS dbo")
+
+    return engine
+
+# Convert one file by route in this process, the result are the measurements of the conversion
+def runConversionBenchmark(route, file, chunksize, label):
+    os.chdir(BENCHMARK_FOLDER)
+
+    db.useEngine(createBenchmarkEngine(BENCHMARK_FOLDER, f"benchmark_{label}"))
+    db.ADAPTIVE_CHUNKSIZE = False
+    db.CHUNKSIZE = chunksize
+    db.METRICS_FILE = f"benchmark_{label}.jsonl"
+    db.METRICS_RUN = label
+    if os.path.exists(db.METRICS_FILE):
+        os.remove(db.METRICS_FILE)
+
+    timing = db.newStageTiming()
+    begin = time.perf_counter()
+    if route == 'chunks':
+        converted = db.createTableFromChunksOfSavFile(file, timing)
+    elif route == 'whole':
+        converted = db.createTableFromSavFile(file, timing)
+    else:
+        converted = db.createTableFromCsvFile(file, timing)
+    seconds = time.perf_counter() - begin
+
+    chunkSeconds = []
+    with open(db.METRICS_FILE) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['event'] == 'chunk':
+                chunkSeconds.append(record['seconds'])
+    os.remove(db.METRICS_FILE)
+
+    rss, peak = db.getMemoryUsage()
+    db.connections.engine.dispose()
+    removeBenchmarkDatabase(BENCHMARK_FOLDER, f"benchmark_{label}")
+    return dict(route=route, converted=converted, rows=timing['rows'], seconds=round(seconds, 3),
+                rows_per_s=round(timing['rows'] / seconds, 1) if seconds > 0 else None,
+                read_s=round(timing['read'], 3), transform_s=round(timing['compact'] + timing['cast'], 3), insert_s=round(timing['insert'], 3),
+                chunks=len(chunkSeconds), chunk_mean_s=round(float(np.mean(chunkSeconds)), 4) if chunkSeconds else None,
+                chunk_max_s=round(max(chunkSeconds), 4) if chunkSeconds else None, peak_rss_mb=round(peak / 1000000, 1))
+
+#
+# Convert synthetic files of growing size by each route and save the measurements to resultsFile, by default
+# benchmark_results_<time>.json in BENCHMARK_FOLDER. Compare two of these files with compareBenchmarkResults.
+#
+def benchmarkConversion(nrRowsList=(100000, 400000), nrColumns=20, typeMix=TYPE_MIX, routes=ROUTES, chunksize=50000, resultsFile=None):
+
+    if resultsFile is None:
+        resultsFile = os.path.join(BENCHMARK_FOLDER, f"benchmark_results_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+
+    print(f"{'rows':>10} {'route':>7} {'seconds':>9} {'rows/s':>10} {'chunks':>7} {'chunk (s)':>10} {'max (s)':>9} {'peak MB':>9}")
+
+    results = []
+    for nrRows in nrRowsList:
+        name = f"benchmark{nrRows}x{nrColumns}"
+        savFile = os.path.join(BENCHMARK_FOLDER, f"{name}.sav")
+        csvFile = os.path.join(BENCHMARK_FOLDER, f"{name}.csv")
+        createMixedSavFile(savFile, nrRows, nrColumns, typeMix, csvFile)
+
+        for route in routes:
+            file = csvFile if route == 'csv' else savFile
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(runConversionBenchmark, route, os.path.basename(file), chunksize, f"{name}_{route}").result()
+
+            result.update(nrRows=nrRows, nrColumns=nrColumns, chunksize=chunksize)
+            results.append(result)
+            print(f"{nrRows:>10} {route:>7} {result['seconds']:>9.2f} {result['rows_per_s']:>10.0f} {result['chunks']:>7} "
+                  f"{result['chunk_mean_s'] or 0:>10.4f} {result['chunk_max_s'] or 0:>9.4f} {result['peak_rss_mb']:>9.1f}")
+
+        os.remove(savFile)
+        os.remove(csvFile)
+
+    with open(resultsFile, 'w') as f:
+        json.dump(dict(time=datetime.datetime.now().isoformat(timespec='seconds'), typeMix=typeMix, results=results), f, indent=2)
+    print(f"Results in {resultsFile}")
+
+    return resultsFile
+
+# Compare the rows/s and peak memory of two results files of benchmarkConversion, per route and size
+def compareBenchmarkResults(beforeFile, afterFile):
+    with open(beforeFile) as f:
+        before = {(result['route'], result['nrRows'], result['nrColumns']): result for result in json.load(f)['results']}
+    with open(afterFile) as f:
+        after = {(result['route'], result['nrRows'], result['nrColumns']): result for result in json.load(f)['results']}
+
+    print(f"{'rows':>10} {'route':>7} {'rows/s before':>14} {'rows/s after':>13} {'change':>8} {'peak MB before':>15} {'peak MB after':>14}")
+
+    for key in sorted(before.keys() & after.keys(), key=lambda key: (key[1], key[0])):
+        route, nrRows, nrColumns = key
+        old, new = before[key], after[key]
+        change = new['rows_per_s'] / old['rows_per_s'] - 1 if old['rows_per_s'] else 0.0
+        print(f"{nrRows:>10} {route:>7} {old['rows_per_s']:>14.0f} {new['rows_per_s']:>13.0f} {change:>+8.1%} "
+              f"{old['peak_rss_mb']:>15.1f} {new['peak_rss_mb']:>14.1f}")
+
+    return
+
+#
+# Call of functions
+#
+#  > python benchmark.py
+#
+#  > import benchmark as bm
+#  > before = bm.benchmarkConversion()
+#  > ... change the conversion ...
+#  > bm.compareBenchmarkResults(before, bm.benchmarkConversion())
+#
+if __name__ == "__main__":
+    benchmarkChunksOfSavFile()
+    benchmarkCsvSniffing()
+    benchmarkConversion()
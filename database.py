@@ -37,12 +37,31 @@
 #
 
 import os
+import re
 import gc
+import time
+import datetime
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import subprocess
+import configparser
+import csv
+import psutil
 import files as fs
+import numpy as np
 import pandas as pd
-import pyodbc as db
 import urllib.parse
-from sqlalchemy import create_engine
+from types import SimpleNamespace
+from sqlalchemy import create_engine, table as sqlTable, column as sqlColumn
+from sqlalchemy import MetaData, Table, Column, Index, PrimaryKeyConstraint, select, delete, func, inspect
+from sqlalchemy import types as sqlTypes
+from sqlalchemy.dialects import mssql
+from sqlalchemy.exc import IntegrityError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from queue import Queue, Full
 import pyreadstat as sav
 import string
 
@@ -56,14 +75,230 @@ from sqlalchemy import event
 # Package startup code
 #
 global CHUNKSIZE
-CHUNKSIZE = 1000000              # The size of the chunks while converting sav files
+CHUNKSIZE = 1000000              # The size of the chunks while converting sav files, the maximum if adaptive
+
+global ADAPTIVE_CHUNKSIZE
+ADAPTIVE_CHUNKSIZE = True        # Choose the size of the chunks of each sav file from its row width and CHUNK_MEMORY_BUDGET
+
+global CHUNK_MEMORY_BUDGET
+CHUNK_MEMORY_BUDGET = 1000000000 # 1 Gigabyte, the RAM of one chunk in a dataframe
+
+global MIN_CHUNKSIZE
+MIN_CHUNKSIZE = 10000            # The smallest adaptive chunk size
+
+global INSERT_BATCH_SIZE
+INSERT_BATCH_SIZE = 100000       # The rows of each executemany of a chunk, adaptive chunk sizes are rounded down to a multiple of it
 
 global MAX_SAV_FILE_SIZE
-MAX_SAV_FILE_SIZE = 32000000000  # 32 Gigabyte
+MAX_SAV_FILE_SIZE = 32000000000  # 32 Gigabyte, also the RAM budget of all files converted at the same time
+
+global MAX_WORKERS
+MAX_WORKERS = 1                  # The number of sav files converted at the same time, each in its own process
+
+global PIPELINE_DEPTH
+PIPELINE_DEPTH = 1               # The number of chunks read ahead while inserting a chunk, 0 reads and inserts in turn
+
+global LOADER
+LOADER = 'to_sql'                # The insert of chunks: 'to_sql', 'bcp' (bulk copy utility of SQL Server) or 'local' (stand-in of bcp)
+
+global STAGING_FOLDER
+STAGING_FOLDER = tempfile.gettempdir()  # The folder of the staging files of a bulk load
+
+# Terminators of the staging files (ASCII unit and record separator), these do not occur in CBS data
+FIELD_TERMINATOR = '\x1f'
+ROW_TERMINATOR = '\x1e'
+
+# The staging files are not quoted, chunks with these characters in a string are loaded by to_sql
+STAGING_SPECIAL_CHARACTERS = '[\x1f\x1e"\r\n\x00]'
+
+# An empty string in a staging file, a field without characters is loaded as NULL
+EMPTY_STRING = '\x00'
+
+bcpVersion = None
+
+global EXPLICIT_COLUMN_TYPES
+EXPLICIT_COLUMN_TYPES = True     # Create tables with column types derived from the sav metadata, instead of types inferred by pandas
+
+# The range of values of the SQL integer types
+INTEGER_RANGES = {
+    'TINYINT': (0, 255),
+    'SMALLINT': (-32768, 32767),
+    'INT': (-2147483648, 2147483647),
+    'BIGINT': (-9223372036854775808, 9223372036854775807),
+}
+
+global COMPACT_CHUNKS
+COMPACT_CHUNKS = False           # Downcast the columns of each chunk in memory before insert, to allow larger chunks
+
+global CATEGORY_RATIO
+CATEGORY_RATIO = 0.5             # String columns with less unique values than this fraction of rows become categoricals
+
+#
+# Checkpoint ledger of the conversions, a control table in the database. Each chunk is committed
+# together with its checkpoint: the rows of the file it covers, the size and modification time of
+# the file, and a checksum of the chunk. Its name does not end with "_", like the converted tables.
+#
+ledgerMetadata = MetaData()
+checkpoints = Table('CONVERSIONCHECKPOINTS', ledgerMetadata,
+    Column('table_name', sqlTypes.String(128), nullable=False),
+    Column('row_offset', sqlTypes.BigInteger, nullable=False),
+    Column('row_count', sqlTypes.BigInteger, nullable=False),
+    Column('file_size', sqlTypes.BigInteger, nullable=False),
+    Column('file_mtime', sqlTypes.Float(precision=53), nullable=False),
+    Column('checksum', sqlTypes.String(16), nullable=False),
+    Column('committed_at', sqlTypes.DateTime, nullable=False),
+    Column('byte_offset', sqlTypes.BigInteger, nullable=True),  # csv files: the byte position after the chunk
+    PrimaryKeyConstraint('table_name', 'row_offset'),
+    schema='dbo')
+
+#
+# Fingerprints of the source files of the tables, stored when a conversion is completed. A file of which the size
+# and modification time are as stored is unchanged, without reading it. Otherwise its fingerprint of files.py
+# tells whether its contents changed, or only its modification time.
+#
+fingerprints = Table('SOURCEFINGERPRINTS', ledgerMetadata,
+    Column('table_name', sqlTypes.String(128), nullable=False),
+    Column('file', sqlTypes.Unicode(1000), nullable=False),
+    Column('file_size', sqlTypes.BigInteger, nullable=False),
+    Column('file_mtime', sqlTypes.Float(precision=53), nullable=False),
+    Column('fingerprint', sqlTypes.String(40), nullable=False),
+    Column('converted_at', sqlTypes.DateTime, nullable=False),
+    PrimaryKeyConstraint('table_name'),
+    schema='dbo')
+
+#
+# The row ranges of the files converted in partitions, stored when the conversion of a file starts, so that a
+# conversion continued with other PARTITION_WORKERS or PARTITION_ROWS keeps the ranges of its {table}PART{n} tables.
+#
+partitionRanges = Table('PARTITIONRANGES', ledgerMetadata,
+    Column('table_name', sqlTypes.String(128), nullable=False),
+    Column('range_index', sqlTypes.Integer, nullable=False),
+    Column('row_start', sqlTypes.BigInteger, nullable=False),
+    Column('row_end', sqlTypes.BigInteger, nullable=False),
+    PrimaryKeyConstraint('table_name', 'range_index'),
+    schema='dbo')
+
+ledgerCreated = False
+
+#
+# Value labels of the converted tables, in control tables. VALUELABELSETS holds each set of codes and
+# labels once, keyed by a hash of its contents, so a set shared by columns, files and years is stored once.
+# VALUELABELSETKEYS has one row per set, inserted in the same transaction as its labels, so a set stored
+# by two processes at the same time is inserted by one of them only.
+# VALUELABELVARIABLES links each labelled column of a table to its set. The tables keep the codes.
+#
+valueLabelSetKeys = Table('VALUELABELSETKEYS', ledgerMetadata,
+    Column('label_set', sqlTypes.String(40), nullable=False),
+    Column('numeric_codes', sqlTypes.Boolean, nullable=False),
+    Column('number_labels', sqlTypes.Integer, nullable=False),
+    PrimaryKeyConstraint('label_set'),
+    schema='dbo')
+
+valueLabelSets = Table('VALUELABELSETS', ledgerMetadata,
+    Column('label_set', sqlTypes.String(40), nullable=False),
+    Column('code_number', sqlTypes.Float(precision=53), nullable=True),  # the code of numeric columns
+    Column('code_string', sqlTypes.Unicode(255), nullable=True),         # the code of string columns
+    Column('label', sqlTypes.Unicode(255), nullable=False),
+    Index('IX_VALUELABELSETS', 'label_set'),
+    schema='dbo')
+
+valueLabelVariables = Table('VALUELABELVARIABLES', ledgerMetadata,
+    Column('table_name', sqlTypes.String(128), nullable=False),
+    Column('column_name', sqlTypes.String(128), nullable=False),
+    Column('label_set', sqlTypes.String(40), nullable=False),
+    Column('numeric_codes', sqlTypes.Boolean, nullable=False),
+    PrimaryKeyConstraint('table_name', 'column_name'),
+    schema='dbo')
+
+valueLabelTablesCreated = False
+
+global PARQUET_CACHE
+PARQUET_CACHE = False            # Stage sav files in the Parquet cache of files.py, and load from it if cached (needs pyarrow)
+
+global STAGED_LOAD
+STAGED_LOAD = False              # Load into a staging heap with table locks and swap it in at the end, also files above MAX_SAV_FILE_SIZE
+
+global STAGED_INDEX_COLUMNS
+STAGED_INDEX_COLUMNS = ['RINPERSOON']  # The columns of the clustered index built on the staging table before the swap, if present
+
+# The suffix of the staging tables, their name does not end with "_" like the converted tables
+STAGING_SUFFIX = 'STAGE'
+
+global PARTITIONED_LOAD
+PARTITIONED_LOAD = False         # Convert files above MAX_SAV_FILE_SIZE in row ranges by PARTITION_WORKERS processes at the same time, needs STAGED_LOAD
+
+global PARTITION_WORKERS
+PARTITION_WORKERS = 4            # The number of row ranges of a file converted at the same time, each in its own process
+
+global PARTITION_ROWS
+PARTITION_ROWS = 20000000        # The largest number of rows of a range, a file has at least PARTITION_WORKERS ranges
+
+global BUILD_INDEXES
+BUILD_INDEXES = False            # Build the indexes on the key columns of the converted tables at the end of a run
+
+global INDEX_WORKERS
+INDEX_WORKERS = 4                # The number of tables of which the indexes are built at the same time
+
+global COLUMNSTORE_MIN_COLUMNS
+COLUMNSTORE_MIN_COLUMNS = 30     # Tables with at least this many columns and COLUMNSTORE_MIN_ROWS rows get a clustered columnstore index
+
+global COLUMNSTORE_MIN_ROWS
+COLUMNSTORE_MIN_ROWS = 1000000   # A columnstore compresses rows in groups of about a million rows
+
+# The key columns of persons, households, addresses and objects, joined on by the analyses. The source code of
+# a key, like RINPERSOONS of RINPERSOON, is indexed together with its key, in front of it, not on its own.
+KEY_COLUMN_PATTERN = re.compile(r"^(RIN[A-Z]*|HUISHOUDNR|HUISHOUDENSNR)$", re.IGNORECASE)
+
+# The key columns of the clustered index, the first one present in a table
+CLUSTERED_KEY_COLUMNS = ['RINPERSOON', 'HUISHOUDNR', 'HUISHOUDENSNR', 'RINADRES', 'RINOBJECTNUMMER']
+
+global VERIFY_LOADS
+VERIFY_LOADS = False             # Compare the aggregates of the chunks, taken while converting, with the same aggregates of the table
+
+global VERIFY_KEY_COLUMNS
+VERIFY_KEY_COLUMNS = ['RINPERSOON']  # Key columns, integers or strings of digits, of which a hash of all values is compared, if present
+
+# The hash of a key value: a step of the Lehmer generator, computed the same in pandas and in SQL
+KEY_HASH_MODULUS = 2147483647
+KEY_HASH_MULTIPLIER = 48271
+
+# The largest number of columns aggregated in one query of the verification, the rest in the next queries
+VERIFY_QUERY_COLUMNS = 500
+
+global CHANGE_DETECTION
+CHANGE_DETECTION = True          # Skip files unchanged since their conversion, and convert changed files again from the start
+
+global FAMILY_TABLES
+FAMILY_TABLES = False            # Combine the tables of yearly and versioned files of a family in the view {family}FAMILY_ after a run
+
+global VALUE_LABELS
+VALUE_LABELS = False             # Store the value labels of each converted sav file in VALUELABELSETS and VALUELABELVARIABLES
+
+global METRICS_FILE
+METRICS_FILE = 'conversion_metrics.jsonl'  # JSON lines of the timing and memory of each chunk, file and run, None to switch off
+
+global METRICS_RUN
+METRICS_RUN = None               # The start time of the current run, to tell the runs apart in the METRICS_FILE
+
+# The largest resident memory of this process sampled since the start of the current file, in bytes
+peakMemory = 0
+
+# The start of the current run, for its throughput
+runBegin = time.perf_counter()
+
+# The settings copied to the worker processes of a parallel conversion
+WORKER_SETTINGS = ['DATABASE_CONFIG', 'CHUNKSIZE', 'ADAPTIVE_CHUNKSIZE', 'CHUNK_MEMORY_BUDGET', 'MIN_CHUNKSIZE', 'INSERT_BATCH_SIZE', 'MAX_SAV_FILE_SIZE', 'PIPELINE_DEPTH', 'LOADER', 'STAGING_FOLDER', 'EXPLICIT_COLUMN_TYPES',
+                   'COMPACT_CHUNKS', 'CATEGORY_RATIO', 'PARQUET_CACHE', 'METRICS_FILE', 'METRICS_RUN', 'tableSnapshot',
+                   'STAGED_LOAD', 'STAGED_INDEX_COLUMNS', 'PARTITIONED_LOAD', 'VALUE_LABELS', 'CHANGE_DETECTION',
+                   'VERIFY_LOADS', 'VERIFY_KEY_COLUMNS']
+
+# The settings of files.py copied to the worker processes, spawned workers import files.py with its defaults
+FILES_WORKER_SETTINGS = ['METADATA_CATALOG', 'PARQUET_CACHE_FOLDER', 'PARQUET_CACHE_BUDGET', 'CONVERSION_SPECS', 'FINGERPRINT_BLOCKS',
+                         'FINGERPRINT_BLOCK_BYTES', 'CSV_CHUNK_BYTES', 'CSV_SAMPLE_BYTES', 'CSV_TYPE_HEADROOM', 'CSV_DELIMITERS',
+                         'FIXED_CHAR_WIDTH']
 
-global sqlserver
-global engine
-global cursor
+global DATABASE_CONFIG
+DATABASE_CONFIG = 'database.ini'  # Optional settings of the connection in section [database], overruled by CBS_<SETTING> in the environment
 
 driver   = 'DRIVER={ODBC Driver 13 for SQL Server};'
 server   = 'SERVER=S0DSQL0141B\I01;'
@@ -72,87 +307,1055 @@ username = 'UID=RA<fill in project number CBS>;'
 password = 'PWD=<fill in your DB general password'
 
 connectString = driver + server + database + username + password
-sqlserver = db.connect(connectString)
-db_params = urllib.parse.quote_plus(connectString)
-engine = create_engine("mssql+pyodbc:///?odbc_connect={}".format(db_params), execution_options=dict(stream_results=True))
-cursor = sqlserver.cursor()
-cursor.close()
+
+# The settings of the connection and its pool, and their defaults. The ODBC keywords replace those of connectString,
+# connect_string replaces it as a whole, and url connects to another database than SQL Server.
+CONNECTION_SETTINGS = dict(connect_string=None, driver=None, server=None, database=None, uid=None, pwd=None, url=None,
+                           pool_size=4, max_overflow=4, pool_timeout=30, pool_recycle=3600, fast_executemany=True)
 
 #
 # To make it faster compared to one-to-one insertion of rows (see notes of Kiran Kumar Chilla)
 #
-@event.listens_for(engine,"before_cursor_execute")
 def receive_before_cursor_execute(sqlserver, cursor, statement, connectString, context, executemany):
-    if executemany:
-        cursor.fast_executemany = True  # Change to False if utf-8 conversion failure in csv files, TODO: make parameter!
+    if executemany and connections.settings['fast_executemany']:
+        cursor.fast_executemany = True  # Set CBS_FAST_EXECUTEMANY=false if utf-8 conversion failure in csv files
+    return
+
+#
+# The connections to the database of a process. The engine and its pool are created on first use, and again
+# in each new process, because pooled connections can not be shared with a forked or spawned worker. Functions
+# borrow a connection of the pool with connect(), and return it at the end of their with block.
+#
+class ConnectionManager:
+
+    def __init__(self):
+        self.otherEngine = None
+        self.processEngine = None
+        self.pid = None
+        self.settings = None
+        return
+
+    # The settings of CONNECTION_SETTINGS, overruled by DATABASE_CONFIG and then by the environment
+    def readSettings(self) -> dict:
+        settings = dict(CONNECTION_SETTINGS)
+
+        config = configparser.ConfigParser()
+        config.read(DATABASE_CONFIG)
+        if config.has_section('database'):
+            settings.update({name: value for name, value in config['database'].items() if name in settings})
+
+        for name in settings:
+            value = os.environ.get(f"CBS_{name.upper()}")
+            if value is not None:
+                settings[name] = value
+
+        for name in ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']:
+            settings[name] = int(settings[name])
+        if isinstance(settings['fast_executemany'], str):
+            settings['fast_executemany'] = settings['fast_executemany'].lower() in ['1', 'true', 'yes', 'on']
+
+        return settings
+
+    # The ODBC connect string of the settings
+    def getConnectString(self) -> str:
+        settings = self.settings or self.readSettings()
+        if settings['connect_string']:
+            return settings['connect_string']
+
+        keywords = {}
+        for item in connectString.split(';'):
+            if '=' in item:
+                key, value = item.split('=', 1)
+                keywords[key.strip().upper()] = value.strip()
+        for name in ['driver', 'server', 'database', 'uid', 'pwd']:
+            if settings[name]:
+                keywords[name.upper()] = '{' + settings[name] + '}' if name == 'driver' else settings[name]
+
+        return ''.join(f"{key}={value};" for key, value in keywords.items())
+
+    def createEngine(self):
+        self.settings = self.readSettings()
+        pool = dict(pool_size=self.settings['pool_size'], max_overflow=self.settings['max_overflow'],
+                    pool_timeout=self.settings['pool_timeout'], pool_recycle=self.settings['pool_recycle'], pool_pre_ping=True)
+
+        if self.settings['url']:
+            return create_engine(self.settings['url'])
+
+        db_params = urllib.parse.quote_plus(self.getConnectString())
+        processEngine = create_engine("mssql+pyodbc:///?odbc_connect={}".format(db_params), execution_options=dict(stream_results=True), **pool)
+        event.listen(processEngine, "before_cursor_execute", receive_before_cursor_execute)
+        return processEngine
+
+    # The engine of this process, created on first use
+    @property
+    def engine(self):
+        if self.pid != os.getpid():
+            # Connections inherited from a forked parent can not be shared, leave them to the parent
+            for inherited in [self.processEngine, self.otherEngine]:
+                if inherited is not None:
+                    inherited.dispose(close=False)
+            self.processEngine = None
+            self.pid = os.getpid()
+
+        if self.otherEngine is not None:
+            return self.otherEngine
+
+        if self.processEngine is None:
+            self.processEngine = self.createEngine()
+
+        return self.processEngine
+
+    # Borrow a connection of the pool
+    def connect(self):
+        return self.engine.connect()
+
+    # Borrow a connection of the pool in a transaction, committed at the end of the with block
+    def begin(self):
+        return self.engine.begin()
+
+    # Use another engine than the one of the settings, like the SQLite engine of the benchmark
+    def useEngine(self, otherEngine):
+        self.otherEngine = otherEngine
+        self.pid = os.getpid()
+        return
+
+    # Close the pooled connections, the next use opens new ones
+    def dispose(self):
+        if self.processEngine is not None:
+            self.processEngine.dispose()
+        self.processEngine = None
+        self.settings = None
+        return
+
+connections = ConnectionManager()
+
+# Use another engine than SQL Server, like the SQLite engine of the benchmark. Its schema dbo holds the tables.
+def useEngine(otherEngine):
+    connections.useEngine(otherEngine)
     return
 
 #
 # Functions
 #
 def printDatabaseVersion():
-    cursor = sqlserver.cursor()
-    cursor.execute("SELECT @@version;")
-    print(cursor.fetchone())
-    cursor.close()
+    with connections.connect() as connection:
+        print(connection.exec_driver_sql("SELECT @@version;").fetchone())
     return
 
 def printAllTables():
-    cursor = sqlserver.cursor()
-    cursor.execute("SELECT * FROM information_schema.tables")
-    for row in cursor.fetchall():
-        print(row)
-    cursor.close()
+    with connections.connect() as connection:
+        for row in connection.exec_driver_sql("SELECT * FROM information_schema.tables").fetchall():
+            print(row)
     return
 
 def getAllTables() -> list:
-    tableList = []
-    cursor = sqlserver.cursor()
-    cursor.execute("SELECT * FROM information_schema.tables WHERE TABLE_NAME LIKE '%[_]'")
-    for row in cursor.fetchall():
-        tableList.append(row)
-    cursor.close()
-    return tableList
+    with connections.connect() as connection:
+        return list(connection.exec_driver_sql("SELECT * FROM information_schema.tables WHERE TABLE_NAME LIKE '%[_]'").fetchall())
+
+#
+# Snapshot of the tables of the database and their approximate number of records, keyed by the upper case
+# table name. SQL Server gives all tables and their row counts of sys.partitions in one query, instead of
+# a query per file. The snapshot is loaded once, handed to the worker processes, and updated by the
+# conversions of each process as their chunks commit.
+#
+tableSnapshot = None
+
+def loadTableSnapshot() -> dict:
+    with connections.connect() as connection:
+        if connection.dialect.name == 'mssql':
+            rows = connection.exec_driver_sql(
+                "SELECT t.name, SUM(p.rows) FROM sys.tables t "
+                "JOIN sys.schemas s ON s.schema_id = t.schema_id "
+                "JOIN sys.partitions p ON p.object_id = t.object_id AND p.index_id IN (0, 1) "
+                "WHERE s.name = 'dbo' GROUP BY t.name").fetchall()
+        else:
+            # Other databases, like the SQLite of the benchmark, have no row counts without a scan
+            rows = []
+            for table in inspect(connection).get_table_names(schema='dbo'):
+                rows.append((table, connection.execute(select(func.count()).select_from(sqlTable(table, schema='dbo'))).scalar()))
+
+    return {table.upper(): int(nrRecords or 0) for table, nrRecords in rows}
+
+# The snapshot of the tables of this process, loaded on first use or if refresh
+def getTableSnapshot(refresh=False) -> dict:
+    global tableSnapshot
+
+    if tableSnapshot is None or refresh:
+        tableSnapshot = loadTableSnapshot()
+
+    return tableSnapshot
+
+# Add committed records of a table to the snapshot, a new table is added with them
+def addTableRecords(table, nrRecords):
+    snapshot = getTableSnapshot()
+    snapshot[table.upper()] = snapshot.get(table.upper(), 0) + nrRecords
+    return
+
+def removeTable(table):
+    getTableSnapshot().pop(table.upper(), None)
+    return
 
 def tableExists(table) -> bool:
-    cursor = sqlserver.cursor()
-    cursor.execute(f"SELECT COUNT(*) FROM information_schema.tables WHERE table_schema='dbo' AND table_name='{table}'")
-    exists = cursor.fetchone()[0] == 1
-    cursor.close()
-    return exists
+    return table.upper() in getTableSnapshot()
+
+# The number of records of a table in the snapshot, approximate for tables not converted by this process
+def approximateNumberTableRecords(table):
+    return getTableSnapshot().get(table.upper(), 0)
 
 def countTableNumberRecords(table):
-    cursor = sqlserver.cursor()
-    cursor.execute(f"SELECT COUNT(*) FROM [RA8552].[dbo].[{table}]")
-    nrRows = cursor.fetchone()[0]
-    cursor.close()
-    return nrRows
+    with connections.connect() as connection:
+        return connection.execute(select(func.count()).select_from(sqlTable(table, schema='dbo'))).scalar()
 
 def dropTable(table):
-    cursor = sqlserver.cursor()    
-    cursor.execute(f"DROP TABLE [RA8552].[dbo].[{table}]")
-    cursor.close()
+    with connections.begin() as connection:
+        Table(table, MetaData(), schema='dbo').drop(connection)
+    removeTable(table)
+    deleteCheckpoints(table)
+    return
+
+def numberTableRecords(table):
+    if not(tableExists(table)):
+        return 0
+    return countTableNumberRecords(table)
+
+#
+# The chunk size of a row size in bytes: as many rows as fit in CHUNK_MEMORY_BUDGET, rounded down to
+# whole insert batches, between MIN_CHUNKSIZE and CHUNKSIZE. Resume works on row offsets, so the chunk
+# size can differ between runs.
+#
+def getChunksizeOfRowSize(rowSize) -> int:
+    chunksize = int(CHUNK_MEMORY_BUDGET // max(rowSize, 1))
+    if chunksize >= INSERT_BATCH_SIZE:
+        chunksize -= chunksize % INSERT_BATCH_SIZE
+    return max(MIN_CHUNKSIZE, min(CHUNKSIZE, chunksize))
+
+def getChunksizeOfSavFile(table, file) -> int:
+    if not(ADAPTIVE_CHUNKSIZE):
+        return CHUNKSIZE
+
+    rowSize = fs.estimateRowSizeOfSavFile(file)
+    chunksize = getChunksizeOfRowSize(rowSize)
+    print(f"{table}: {rowSize:.0f} bytes per record in memory, chunks of {chunksize} records")
+
+    return chunksize
+
+#
+# The time spent in each stage of a conversion. The transform stage is the compaction of the chunks, done
+# on the read side, and the cast to the column types, done on the insert side; both are kept out of the
+# read and insert time.
+#
+def newStageTiming() -> dict:
+    return dict(read=0.0, compact=0.0, cast=0.0, insert=0.0, waitForRead=0.0, waitForInsert=0.0, rows=0, chunks=0)
+
+# Measure the time to read each chunk, when reading and inserting take turns
+def timeChunks(chunks, timing):
+    begin = time.perf_counter()
+    compact = timing['compact']
+    for chunk in chunks:
+        seconds = time.perf_counter() - begin
+        timing['read'] += seconds - (timing['compact'] - compact)
+        timing['waitForRead'] += seconds
+        yield chunk
+        begin = time.perf_counter()
+        compact = timing['compact']
     return
 
-def createChunkCsvFiles(table,file):
-    chunknr = 0
-    delimiter = fs.delimiterCsvFile(file)
-    for chunk in pd.read_csv(file, delimiter=delimiter, engine='python', chunksize=CHUNKSIZE):
-        chunk.to_csv(f"{table}.{str(chunknr)}", index=False)
-        print(f"{table} imported: {str(len(chunk))}. Saved to {table}.{str(chunknr)}.")
-        chunknr += 1
+#
+# Read the chunks in a background thread while the caller inserts the previous chunk.
+# The bounded queue holds at most depth chunks, so at most depth + 2 chunks are in memory:
+# the one being read, the ones in the queue and the one being inserted.
+#
+def prefetchChunks(chunks, depth, timing):
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        begin = time.perf_counter()
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                break
+            except Full:
+                pass
+        timing['waitForInsert'] += time.perf_counter() - begin
+        return
+
+    def read():
+        try:
+            begin = time.perf_counter()
+            compact = timing['compact']
+            for chunk in chunks:
+                timing['read'] += time.perf_counter() - begin - (timing['compact'] - compact)
+                put(chunk)
+                if stop.is_set():
+                    return
+                begin = time.perf_counter()
+                compact = timing['compact']
+            put(end)
+        except Exception as ex:
+            put(ex)
+        return
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            begin = time.perf_counter()
+            item = queue.get()
+            timing['waitForRead'] += time.perf_counter() - begin
+
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
     return
 
-def numberTableRecords(table):
+# The stage with the most busy time is the bottleneck, the other stage waits for it when pipelined
+def printStageTiming(table, timing):
+    bottleneck = 'read' if timing['read'] >= timing['insert'] else 'insert'
+    print(f"{table}: read {timing['read']:.1f} s, transform {timing['compact'] + timing['cast']:.1f} s, insert {timing['insert']:.1f} s, "
+          f"waiting for read {timing['waitForRead']:.1f} s, waiting for insert {timing['waitForInsert']:.1f} s, bottleneck {bottleneck}")
+    return
+
+#
+# Instrumentation of the conversions
+#
+#   Each chunk, file and run is written as one JSON line to METRICS_FILE: the seconds of the read,
+#   transform and insert stages, rows/s, MB/s and the resident memory (RSS) of the process.
+#
+
+# The resident memory of this process and the largest sampled since resetPeakMemory, in bytes. The peak is
+# sampled at the end of each chunk, while the chunk is still in memory. The peak working set kept by Windows
+# is not used: it covers the life of the process, so in a worker also the files it converted before.
+def getMemoryUsage():
+    global peakMemory
+
+    rss = psutil.Process().memory_info().rss
+    peakMemory = max(peakMemory, rss)
+    return rss, peakMemory
+
+# Start the sampled peak memory of a new file at the current resident memory
+def resetPeakMemory():
+    global peakMemory
+
+    peakMemory = 0
+    getMemoryUsage()
+    return
+
+# Append one record to the METRICS_FILE, one short write per line as the worker processes append to it as well
+def writeMetrics(record):
+    if METRICS_FILE is None:
+        return
+
+    record = dict(run=METRICS_RUN, time=datetime.datetime.now().isoformat(timespec='seconds'), pid=os.getpid(), **record)
+    with open(METRICS_FILE, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+    return
+
+# The stage seconds and throughput of a chunk or file, from the stage timing before and after it
+def getStageMetrics(before, after, seconds, nrBytes) -> dict:
+    rows = after['rows'] - before['rows']
+    rss, peak = getMemoryUsage()
+    return dict(rows=rows, seconds=round(seconds, 3),
+                read_s=round(after['read'] - before['read'], 3),
+                transform_s=round(after['compact'] + after['cast'] - before['compact'] - before['cast'], 3),
+                insert_s=round(after['insert'] - before['insert'], 3),
+                wait_for_read_s=round(after['waitForRead'] - before['waitForRead'], 3),
+                rows_per_s=round(rows / seconds, 1) if seconds > 0 else None,
+                mb_per_s=round(nrBytes / 1000000 / seconds, 2) if seconds > 0 else None,
+                rss_mb=round(rss / 1000000, 1), peak_rss_mb=round(peak / 1000000, 1))
+
+# Write the metrics of a chunk inserted since the last call, returns the new begin of the next chunk
+def writeChunkMetrics(file, table, rowOffset, df, timing, previous, begin):
+    end = time.perf_counter()
+    timing['rows'] += df.shape[0]
+    timing['chunks'] += 1
+
+    nrBytes = df.memory_usage(index=False).sum()
+    record = dict(event='chunk', file=file, table=table, chunk=timing['chunks'], row_offset=rowOffset, memory_mb=round(nrBytes / 1000000, 1))
+    record.update(getStageMetrics(previous, timing, end - begin, nrBytes))
+    writeMetrics(record)
+
+    previous.update(timing)
+    return end
+
+#
+# Column types of the tables
+#
+
+# The SQL column types of a sav file, of the columns kept by its conversion spec. None if the types are left to pandas
+def getColumnTypesOfSavFile(meta, spec=None):
+    if not(EXPLICIT_COLUMN_TYPES):
+        return None
+    columnTypes = fs.getSqlColumnTypes(meta)
+    return {column: columnTypes[column] for column in fs.getColumnsOfConversionSpec(spec, meta)}
+
+# The SQL column types of a csv file sniffed from a sample, None if the types are left to pandas
+def getColumnTypesOfCsvFile(file):
+    if not(EXPLICIT_COLUMN_TYPES):
+        return None
+    return fs.sniffCsvFile(file).columnTypes
+
+# The SQLAlchemy type of a SQL column type of fs.getSqlColumnType
+def getSqlType(typeName):
+    if typeName == 'TINYINT':
+        return sqlTypes.SmallInteger().with_variant(mssql.TINYINT(), 'mssql')
+    if typeName == 'SMALLINT':
+        return sqlTypes.SmallInteger()
+    if typeName == 'INT':
+        return sqlTypes.Integer()
+    if typeName == 'BIGINT':
+        return sqlTypes.BigInteger()
+    if typeName == 'DATE':
+        return sqlTypes.Date()
+    if typeName == 'DATETIME2':
+        return sqlTypes.DateTime().with_variant(mssql.DATETIME2(), 'mssql')
+    if typeName == 'TIME':
+        return sqlTypes.Time()
+    if typeName == 'VARCHAR(max)':
+        return sqlTypes.VARCHAR()
+    if typeName.startswith('CHAR('):
+        return sqlTypes.CHAR(int(typeName[5:-1]))
+    if typeName.startswith('VARCHAR('):
+        return sqlTypes.VARCHAR(int(typeName[8:-1]))
+    return sqlTypes.Float(precision=53)
+
+def getDtypeOfColumnTypes(columnTypes):
+    if columnTypes is None:
+        return None
+    return {column: getSqlType(typeName) for column, typeName in columnTypes.items()}
+
+#
+# Cast the float columns of a chunk with an integer column type to integers. The width of
+# an SPSS format only bounds the displayed digits, so a column with values which are not
+# integral or out of range of its type is widened, instead of being rounded by the database:
+# to the smallest integer type of its values, or to FLOAT. The wider type is kept in
+# columnTypes for the next chunks, and the column of an existing table is altered.
+# Columns already downcast to integers by compactChunk are only checked on their range.
+# String columns with longer values than their width, sniffed from a sample of a csv file,
+# are widened to twice the longest value.
+#
+def castChunkToColumnTypes(table, df, columnTypes):
+    if columnTypes is None:
+        return df
+
+    integerColumns = {}
+    for column, typeName in columnTypes.items():
+        # Numeric formats read as dates or times by pyreadstat get the type of their values, the table is created with it
+        if (typeName in INTEGER_RANGES or typeName == 'FLOAT') and column in df.columns and df[column].dtype.kind in 'OM':
+            typeName = getTypeOfTemporalValues(df[column].dropna())
+            if typeName is not None:
+                print(f"{table}: column {column} holds {typeName} values instead of numbers")
+                columnTypes[column] = typeName
+            continue
+
+        width = fs.getWidthOfSqlColumnType(typeName)
+        if width and column in df.columns and df[column].dtype.kind == 'O':
+            length = df[column].str.len().max()
+            if length > width:
+                typeName = widenColumn(table, column, 'VARCHAR(max)' if 2 * length > 8000 else f"VARCHAR({2 * int(length)})")
+                columnTypes[column] = typeName
+            continue
+
+        if typeName not in INTEGER_RANGES or column not in df.columns or df[column].dtype.kind not in 'fiu':
+            continue
+
+        values = df[column].dropna()
+        low, high = INTEGER_RANGES[typeName]
+        if not((values % 1 == 0).all() and values.between(low, high).all()):
+            typeName = widenColumn(table, column, getWiderColumnType(values, typeName))
+            columnTypes[column] = typeName
+
+        if df[column].dtype.kind == 'f' and typeName in INTEGER_RANGES:
+            integerColumns[column] = df[column].astype('Int64')
+
+    return df.assign(**integerColumns)
+
+# The SQL type of a column of Python dates, datetimes or times, None for other values
+def getTypeOfTemporalValues(values):
+    if len(values) == 0:
+        return None
+    if isinstance(values.iloc[0], datetime.datetime):
+        return 'DATETIME2'
+    if isinstance(values.iloc[0], datetime.date):
+        return 'DATE'
+    if isinstance(values.iloc[0], datetime.time):
+        return 'TIME'
+    return None
+
+# The smallest integer type wider than typeName holding the values, FLOAT if none
+def getWiderColumnType(values, typeName) -> str:
+    widerTypes = list(INTEGER_RANGES)[list(INTEGER_RANGES).index(typeName) + 1:]
+    if (values % 1 == 0).all():
+        for widerType in widerTypes:
+            low, high = INTEGER_RANGES[widerType]
+            if values.between(low, high).all():
+                return widerType
+    return 'FLOAT'
+
+# The column types of fs.getSqlColumnType of the columns of a table in the database, from their reflected types
+def getColumnTypesOfTable(table) -> dict:
+    with connections.connect() as connection:
+        return {column['name']: getColumnTypeOfReflectedType(column['type']) for column in inspect(connection).get_columns(table, schema='dbo')}
+
+def getColumnTypeOfTable(table, column):
+    return getColumnTypesOfTable(table).get(column)
+
+def getColumnTypeOfReflectedType(reflectedType):
+    typeName = reflectedType.compile(dialect=connections.engine.dialect).upper().split(' COLLATE')[0]
+    typeName = re.sub(r"^(DATETIME2|TIME)\(\d+\)$", r"\1", typeName)
+    typeName = {'INTEGER': 'INT', 'REAL': 'FLOAT', 'DOUBLE': 'FLOAT', 'DOUBLE PRECISION': 'FLOAT'}.get(typeName, typeName)
+    if typeName.startswith('FLOAT'):
+        return 'FLOAT'
+    if typeName.startswith('VARCHAR(MAX') or typeName == 'VARCHAR':
+        return 'VARCHAR(max)'
+    return typeName
+
+#
+# Widen a column to typeName, the result is its new type. The column of an existing table keeps its type if
+# that is as wide, after a widening in an earlier run, else it is altered on SQL Server, committed before the
+# chunk is inserted, also by bcp in its own session. SQLite stores any value in a column of another type.
+#
+def widenColumn(table, column, typeName):
+    if tableExists(table):
+        current = getColumnTypeOfTable(table, column)
+        if current is not None:
+            typeName = fs.getWidestSqlColumnType([current, typeName])
+            if typeName == current:
+                return typeName
+
+    print(f"{table}: column {column} has values which do not fit its type, widened to {typeName}")
+    if not(tableExists(table)) or connections.engine.dialect.name != 'mssql':
+        return typeName
+
+    statement = f"ALTER TABLE [dbo].[{table}] ALTER COLUMN [{column}] {'FLOAT(53)' if typeName == 'FLOAT' else typeName} NULL"
+    with connections.begin() as connection:
+        connection.exec_driver_sql(statement)
+    return typeName
+
+#
+# In memory compaction of chunks
+#
+#   float columns with integral values   -> smallest (nullable) integer type
+#   date columns of Python date objects  -> datetime64
+#   string columns with few unique values -> categorical
+#
+# pyreadstat returns float64 and object columns only, so this is what makes a chunk
+# use several times the size of the data in the sav file.
+#
+def getSmallestIntegerType(values) -> str:
+    low, high = values.min(), values.max()
+    for typeName in ['Int8', 'Int16', 'Int32']:
+        info = np.iinfo(typeName.lower())
+        if info.min <= low and high <= info.max:
+            return typeName
+    return 'Int64'
+
+def compactChunk(table, df):
+    before = df.memory_usage(deep=True).sum()
+
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+
+        if series.dtype.kind == 'f':
+            values = series.dropna()
+            if len(values) > 0 and (values % 1 == 0).all() and values.abs().max() < 2**53:
+                columns[column] = series.astype(getSmallestIntegerType(values))
+
+        elif series.dtype == object:
+            values = series.dropna()
+            if len(values) == 0:
+                continue
+            if isinstance(values.iloc[0], datetime.date) and not isinstance(values.iloc[0], datetime.datetime):
+                columns[column] = pd.to_datetime(series)
+            elif isinstance(values.iloc[0], str) and values.nunique() < CATEGORY_RATIO * len(series):
+                columns[column] = series.astype('category')
+
+    df = df.assign(**columns)
+
+    after = df.memory_usage(deep=True).sum()
+    print(f"{table}: chunk of {df.shape[0]} records compacted from {before/1000000:.1f} MB to {after/1000000:.1f} MB")
+
+    return df
+
+def compactChunks(table, chunks, timing=None):
+    for df, meta in chunks:
+        begin = time.perf_counter()
+        df = compactChunk(table, df)
+        if timing is not None:
+            timing['compact'] += time.perf_counter() - begin
+        yield df, meta
+    return
+
+#
+# Loaders of chunks into a table
+#
+#   to_sql  parameterised insert batches of pandas (fast_executemany)
+#   bcp     writes the chunk to a staging file and loads it with the bulk copy utility bcp
+#   local   writes the same staging file and loads it with one executemany on the engine,
+#           a stand-in for bcp to test the bulk load path without SQL Server
+#
+# The bulk loaders fall back to to_sql if bcp is not installed, or if the chunk contains
+# the terminators of the staging file, quotes, line breaks or NUL characters. The staging
+# file has no quoting, empty strings are written as a NUL character, as bcp out does, so
+# that bcp in loads them as empty strings instead of NULL.
+#
+def insertChunk(table, df, columnTypes=None, loader=None, connection=None, timing=None):
+    if loader is None:
+        loader = LOADER
+    if connection is None:
+        connection = connections.engine
+
+    begin = time.perf_counter()
+    df = castChunkToColumnTypes(table, df, columnTypes)
+    if timing is not None:
+        timing['cast'] += time.perf_counter() - begin
+    dtype = getDtypeOfColumnTypes(columnTypes)
+
+    if loader != 'to_sql' and not bulkLoadAvailable(table, df, loader):
+        loader = 'to_sql'
+
+    if loader == 'to_sql':
+        method = insertWithTableLock if isStagingTable(table) and connection.dialect.name == 'mssql' else None
+        df.to_sql(table, connection, if_exists='append', index=False, schema='dbo', method=method, dtype=dtype, chunksize=INSERT_BATCH_SIZE)
+        return
+
+    # bcp does not create tables, create an empty table from the columns of the chunk first
     if not(tableExists(table)):
-        return 0, 0, 0
-    nrTableRecords = countTableNumberRecords(table)
-    currentTableChunk = nrTableRecords // CHUNKSIZE
-    currentTableResidue = nrTableRecords % CHUNKSIZE
-    return nrTableRecords, currentTableChunk, currentTableResidue
-
-# Convert a sav-file with whatever size by reading it in chunks
-def createTableFromChunksOfSavFile(file) -> bool:
+        df.head(0).to_sql(table, connections.engine, if_exists='append', index=False, schema='dbo', method=None, dtype=dtype)
+        addTableRecords(table, 0)
+
+    stagingFile = writeStagingFile(table, df)
+    try:
+        if loader == 'bcp':
+            loadStagingFileWithBcp(table, stagingFile)
+        else:
+            loadStagingFileLocal(table, stagingFile, list(df.columns), connection)
+    finally:
+        os.remove(stagingFile)
+
+    return
+
+# The bcp of SQL Server prints its version with -v, other tools named bcp do not
+def bcpInstalled() -> bool:
+    global bcpVersion
+
+    if bcpVersion is None:
+        bcpVersion = ''
+        if shutil.which('bcp') is not None:
+            result = subprocess.run(['bcp', '-v'], capture_output=True, text=True)
+            if 'Microsoft' in result.stdout:
+                bcpVersion = result.stdout.strip()
+
+    return bcpVersion != ''
+
+def bulkLoadAvailable(table, df, loader) -> bool:
+    if loader == 'bcp' and not bcpInstalled():
+        print(f"{table}: bcp of SQL Server not found, falling back to to_sql")
+        return False
+
+    for column in getStringColumns(df):
+        values = df[column].dropna().astype(str)
+        if values.str.contains(STAGING_SPECIAL_CHARACTERS).any():
+            print(f"{table}: column {column} contains staging file terminators, quotes or line breaks, falling back to to_sql")
+            return False
+
+    return True
+
+def getStringColumns(df) -> list:
+    return list(df.select_dtypes(include=['object', 'string', 'category']).columns)
+
+# Write the chunk in character format without quoting, missing values are written as empty fields (NULL)
+# and empty strings as EMPTY_STRING
+def writeStagingFile(table, df) -> str:
+    stringColumns = getStringColumns(df)
+    if stringColumns:
+        df = df.copy()
+        for column in stringColumns:
+            values = df[column].astype(object)
+            df[column] = values.where(values != '', EMPTY_STRING)
+
+    stagingFile = os.path.join(STAGING_FOLDER, f"{table}.{os.getpid()}.bcp")
+    df.to_csv(stagingFile, sep=FIELD_TERMINATOR, lineterminator=ROW_TERMINATOR, header=False, index=False, na_rep='', encoding='utf-8',
+              quoting=csv.QUOTE_NONE)
+    return stagingFile
+
+def getConnectSettings() -> dict:
+    settings = {}
+    for item in connections.getConnectString().split(';'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            settings[key.strip().upper()] = value.strip()
+    return settings
+
+def loadStagingFileWithBcp(table, stagingFile):
+    settings = getConnectSettings()
+    command = ['bcp', f"dbo.{table}", 'in', stagingFile, '-S', settings['SERVER'], '-d', settings['DATABASE'],
+               '-c', '-C', '65001', '-t', '0x1f', '-r', '0x1e']
+
+    if 'UID' in settings:
+        command += ['-U', settings['UID'], '-P', settings.get('PWD', '')]
+    else:
+        command += ['-T']
+
+    if isStagingTable(table):
+        command += ['-h', 'TABLOCK']
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"bcp failed: {result.stdout} {result.stderr}")
+
+    return
+
+def loadStagingFileLocal(table, stagingFile, columns, connection):
+    with open(stagingFile, encoding='utf-8', newline='') as f:
+        rows = f.read().split(ROW_TERMINATOR)
+
+    records = []
+    for row in rows:
+        if row == '':
+            continue
+        values = row.split(FIELD_TERMINATOR)
+        records.append({column: (None if value == '' else '' if value == EMPTY_STRING else value) for column, value in zip(columns, values)})
+
+    target = sqlTable(table, *[sqlColumn(column) for column in columns], schema='dbo')
+
+    def insertRecords(connection):
+        for batch in range(0, len(records), INSERT_BATCH_SIZE):
+            connection.execute(target.insert(), records[batch:batch + INSERT_BATCH_SIZE])
+        return
+
+    # Within the transaction of the chunk and its checkpoint if the caller began one, else in a transaction of its own
+    if not(hasattr(connection, 'in_transaction')):
+        with connection.begin() as engineConnection:
+            insertRecords(engineConnection)
+    elif connection.in_transaction():
+        insertRecords(connection)
+    else:
+        with connection.begin():
+            insertRecords(connection)
+
+    return
+
+#
+# Staged load
+#
+#   A file is loaded into the heap {table}STAGE, without indexes, with a table lock on each insert, and each
+#   chunk commits on its own, so the log can be reused between chunks. Only bulk loads are minimally logged:
+#   with LOADER 'bcp' and the simple or bulk-logged recovery model of the database SQL Server then logs the
+#   allocated pages instead of each row. The INSERT ... VALUES of to_sql is logged row by row, with or without
+#   the table lock. At the end the clustered index is built on the heap, and it is renamed to the table in the
+#   same transaction as its checkpoints. A conversion broken off continues on the staging table.
+#
+
+def getStagingTableName(table) -> str:
+    return table + STAGING_SUFFIX
+
+def isStagingTable(table) -> bool:
+    return STAGED_LOAD and table.endswith(STAGING_SUFFIX)
+
+# The insert method of to_sql on a staging table of SQL Server: one executemany with a table lock, fully logged
+def insertWithTableLock(pdTable, connection, keys, dataIter):
+    columns = ', '.join(f"[{key}]" for key in keys)
+    markers = ', '.join('?' for key in keys)
+    connection.exec_driver_sql(f"INSERT INTO [dbo].[{pdTable.name}] WITH (TABLOCK) ({columns}) VALUES ({markers})", list(dataIter))
+    return
+
+# Build an index on the columns of a table, the result is the time of the build in seconds
+def buildIndex(table, name, indexColumns, clustered=False) -> float:
+    begin = time.perf_counter()
+    indexTable = Table(table, MetaData(), *[Column(column, sqlTypes.Float) for column in indexColumns], schema='dbo')
+    with connections.begin() as connection:
+        Index(name, *[indexTable.c[column] for column in indexColumns], mssql_clustered=clustered).create(connection)
+    return time.perf_counter() - begin
+
+# Build the clustered index on the columns of STAGED_INDEX_COLUMNS of the staging table, named after the table
+def buildIndexOfStagingTable(stage, table):
+    with connections.connect() as connection:
+        columns = [column['name'] for column in inspect(connection).get_columns(stage, schema='dbo')]
+
+    indexColumns = [column for column in STAGED_INDEX_COLUMNS if column in columns]
+    if not(indexColumns):
+        return
+
+    seconds = buildIndex(stage, f"CIX_{table}", indexColumns, clustered=True)
+    print(f"{table}: clustered index on {', '.join(indexColumns)} built in {seconds:.1f} s")
+    return
+
+# Rename the staging table to the table, together with its checkpoints
+def swapStagingTable(stage, table):
+    buildIndexOfStagingTable(stage, table)
+
+    with connections.begin() as connection:
+        if connection.dialect.name == 'mssql':
+            connection.exec_driver_sql(f"EXEC sp_rename 'dbo.[{stage}]', '{table}'")
+        else:
+            connection.exec_driver_sql(f'ALTER TABLE dbo."{stage}" RENAME TO "{table}"')
+        connection.execute(checkpoints.update().where(checkpoints.c.table_name == stage).values(table_name=table))
+
+    nrRecords = approximateNumberTableRecords(stage)
+    removeTable(stage)
+    addTableRecords(table, nrRecords)
+
+    print(f"{table}: staging table {stage} swapped in")
+    return
+
+#
+# Checkpoints
+#
+def createCheckpointLedger():
+    global ledgerCreated
+    if not(ledgerCreated):
+        checkpoints.create(connections.engine, checkfirst=True)
+        fingerprints.create(connections.engine, checkfirst=True)
+        partitionRanges.create(connections.engine, checkfirst=True)
+
+        # Ledgers created before csv files were checkpointed lack the byte offset
+        if 'byte_offset' not in [column['name'] for column in inspect(connections.engine).get_columns(checkpoints.name, schema='dbo')]:
+            with connections.begin() as connection:
+                connection.exec_driver_sql(f"ALTER TABLE dbo.{checkpoints.name} ADD byte_offset BIGINT NULL")
+
+        ledgerCreated = True
+    return
+
+def getChecksumOfChunk(df) -> str:
+    return f"{int(pd.util.hash_pandas_object(df, index=False).sum()) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+def deleteCheckpoints(table):
+    createCheckpointLedger()
+    with connections.begin() as connection:
+        connection.execute(delete(checkpoints).where(checkpoints.c.table_name == table))
+        connection.execute(delete(fingerprints).where(fingerprints.c.table_name == table))
+        connection.execute(delete(partitionRanges).where(partitionRanges.c.table_name == table))
+    return
+
+#
+# The row offset in the file after the last committed chunk, None if the table has no checkpoints.
+# For csv files also the byte offset after that chunk. Raises an error if the file changed since its
+# first chunk was committed, because the table then holds records of another version of the file.
+#
+def getCheckpointOffsets(table, file):
+    createCheckpointLedger()
+
+    query = select(func.max(checkpoints.c.row_offset + checkpoints.c.row_count), func.max(checkpoints.c.byte_offset),
+                   func.min(checkpoints.c.file_size), func.max(checkpoints.c.file_size),
+                   func.min(checkpoints.c.file_mtime), func.max(checkpoints.c.file_mtime)
+                   ).where(checkpoints.c.table_name == table)
+
+    with connections.connect() as connection:
+        offset, byteOffset, minSize, maxSize, minMtime, maxMtime = connection.execute(query).fetchone()
+
+    if offset is None:
+        return None, None
+
+    stat = os.stat(file)
+    if not(minSize == maxSize == stat.st_size and minMtime == maxMtime == stat.st_mtime):
+        raise ValueError(f"{file} changed since the conversion of {table} started, drop the table to convert it again")
+
+    return offset, byteOffset
+
+def getCheckpointOffset(table, file):
+    offset, byteOffset = getCheckpointOffsets(table, file)
+    return offset
+
+# The row offset to continue the conversion: from the checkpoints, or the number of records of tables converted without
+def getResumeOffset(table, file) -> int:
+    if not(tableExists(table)):
+        deleteCheckpoints(table)
+        return 0
+
+    offset = getCheckpointOffset(table, file)
+    if offset is None:
+        offset = numberTableRecords(table)
+
+    return offset
+
+#
+# Insert a chunk covering rowCount rows from rowOffset of the file, and commit it in one transaction
+# together with its checkpoint. bcp loads in its own session, its checkpoint is committed right after.
+#
+def insertChunkWithCheckpoint(table, df, columnTypes, file, rowOffset, rowCount, byteOffset=None, timing=None):
+    stat = os.stat(file)
+    checkpoint = dict(table_name=table, row_offset=rowOffset, row_count=rowCount, file_size=stat.st_size,
+                      file_mtime=stat.st_mtime, checksum=getChecksumOfChunk(df), committed_at=datetime.datetime.now(),
+                      byte_offset=byteOffset)
+
+    with connections.connect() as connection:
+        with connection.begin():
+            insertChunk(table, df, columnTypes, connection=connection, timing=timing)
+            connection.execute(checkpoints.insert(), checkpoint)
+
+    addTableRecords(table, df.shape[0])
+
+    return
+
+#
+# The chunks of a sav file from row offset start: from its Parquet cache if cached, else from the sav file.
+#   Only the given columns are read, all if None; the cache is only written when all columns are read
+#
+def readChunks(file, chunksize, start, meta, columns=None):
+    if not(PARQUET_CACHE) or not(fs.parquetAvailable()):
+        return fs.readChunksOfSavFile(file, chunksize, start, usecols=columns)
+    if fs.parquetCacheExists(file):
+        return fs.readChunksOfParquetCache(file, start, columns)
+    if start == 0 and columns is None:
+        return fs.readChunksOfSavFileIntoCache(file, chunksize, meta)
+    return fs.readChunksOfSavFile(file, chunksize, start, usecols=columns)
+
+#
+# The rows of the chunks passing the conversion spec, each with the number of rows read from the file.
+#   The checkpoints keep the row offsets of the file, so a filtered conversion continues at the same row.
+#
+def filterChunks(chunks, spec):
+    for df, meta in chunks:
+        nrRows = df.shape[0]
+        yield fs.applyConversionSpec(df, spec), nrRows
+    return
+
+#
+# Verification of the loads
+#
+#   The chunks are aggregated while they stream to the table: the number of records, and per column the
+#   number of nulls, for numeric columns also the minimum, maximum and sum, and for the integer columns of
+#   VERIFY_KEY_COLUMNS the sum of the hash of each value. String key columns, like RINPERSOON of format A9,
+#   are hashed as the numbers they hold, values which are not numbers count as 0. After the load the same
+#   aggregates of the table are computed by the server in one scan and compared. The aggregates cover the
+#   whole file only if the load started at its first record, a continued load is not verified.
+#
+
+def newLoadAggregates() -> dict:
+    return dict(rows=0, columns={}, skippedKeys=[])
+
+# Add the aggregates of a chunk, vectorised per aggregate over all columns
+def addChunkAggregates(aggregates, df, columnTypes):
+    aggregates['rows'] += df.shape[0]
+
+    numeric = [column for column in df.columns if df[column].dtype.kind in 'fiu']
+    nulls = df.isna().sum()
+    minimums = df[numeric].min()
+    maximums = df[numeric].max()
+    sums = df[numeric].sum()
+
+    for column in df.columns:
+        columnAggregates = aggregates['columns'].setdefault(column, dict(nulls=0))
+        columnAggregates['nulls'] += int(nulls[column])
+
+    for column in numeric:
+        columnAggregates = aggregates['columns'][column]
+        columnAggregates['min'] = float(np.fmin(columnAggregates.get('min', np.nan), minimums[column]))
+        columnAggregates['max'] = float(np.fmax(columnAggregates.get('max', np.nan), maximums[column]))
+        columnAggregates['sum'] = columnAggregates.get('sum', 0.0) + float(sums[column])
+
+    for column in VERIFY_KEY_COLUMNS:
+        if column not in df.columns:
+            continue
+
+        columnAggregates = aggregates['columns'][column]
+        if column in numeric and columnTypes is not None and columnTypes.get(column) in INTEGER_RANGES:
+            aggregate = 'keyhash'
+            values = df[column].dropna().astype('int64').abs()
+        elif df[column].dtype.kind == 'O' and 'keyhash' not in columnAggregates:
+            aggregate = 'stringkeyhash'
+            values = df[column].dropna().astype(str).str.strip()
+            values = values[values.str.fullmatch(r'[-+]?\d{1,18}')].astype('int64').abs()
+        else:
+            if column not in aggregates['skippedKeys']:
+                print(f"Key column {column} of type {df[column].dtype} is not hashed in the verification")
+                aggregates['skippedKeys'].append(column)
+            continue
+
+        columnAggregates[aggregate] = columnAggregates.get(aggregate, 0) + int((values % KEY_HASH_MODULUS * KEY_HASH_MULTIPLIER % KEY_HASH_MODULUS).sum())
+
+    return
+
+def aggregateChunks(chunks, aggregates, columnTypes):
+    for df, nrRows in chunks:
+        addChunkAggregates(aggregates, df, columnTypes)
+        yield df, nrRows
+    return
+
+# The same aggregates of a table, computed by the server in one scan per VERIFY_QUERY_COLUMNS columns
+def getTableAggregates(table, aggregates) -> dict:
+    tableAggregates = dict(rows=None, columns={})
+    columns = list(aggregates['columns'].keys())
+
+    with connections.connect() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        for first in range(0, max(len(columns), 1), VERIFY_QUERY_COLUMNS):
+            fields = ['COUNT(*)']
+            names = [('rows', None)]
+            for column in columns[first:first + VERIFY_QUERY_COLUMNS]:
+                name = quote(column)
+                fields.append(f"COUNT(*) - COUNT({name})")
+                names.append(('nulls', column))
+                if 'sum' in aggregates['columns'][column]:
+                    fields += [f"MIN({name})", f"MAX({name})", f"SUM(CAST({name} AS FLOAT))"]
+                    names += [('min', column), ('max', column), ('sum', column)]
+                if 'keyhash' in aggregates['columns'][column]:
+                    fields.append(f"SUM(ABS(CAST({name} AS BIGINT)) % {KEY_HASH_MODULUS} * {KEY_HASH_MULTIPLIER} % {KEY_HASH_MODULUS})")
+                    names.append(('keyhash', column))
+                if 'stringkeyhash' in aggregates['columns'][column]:
+                    cast = 'TRY_CAST' if connection.dialect.name == 'mssql' else 'CAST'
+                    fields.append(f"SUM(ABS({cast}(LTRIM(RTRIM({name})) AS BIGINT)) % {KEY_HASH_MODULUS} * {KEY_HASH_MULTIPLIER} % {KEY_HASH_MODULUS})")
+                    names.append(('stringkeyhash', column))
+
+            row = connection.exec_driver_sql(f"SELECT {', '.join(fields)} FROM dbo.{quote(table)}").fetchone()
+            for (aggregate, column), value in zip(names, row):
+                if column is None:
+                    tableAggregates['rows'] = value
+                else:
+                    tableAggregates['columns'].setdefault(column, {})[aggregate] = value
+
+    return tableAggregates
+
+# An aggregate of the table equals the aggregate of the chunks: exactly for counts and hashes, else up to rounding
+def equalAggregate(aggregate, value, tableValue) -> bool:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return tableValue is None
+    if tableValue is None:
+        return False
+    if aggregate in ['nulls', 'keyhash', 'stringkeyhash']:
+        return int(value) == int(tableValue)
+    return bool(np.isclose(float(value), float(tableValue), rtol=1e-9 if aggregate != 'sum' else 1e-6, atol=1e-6))
+
+# Compare the aggregates of the chunks with the table, report the differences. True if none.
+def verifyTable(table, aggregates) -> bool:
+    begin = time.perf_counter()
+    tableAggregates = getTableAggregates(table, aggregates)
+
+    differences = []
+    if tableAggregates['rows'] != aggregates['rows']:
+        differences.append(f"records {aggregates['rows']} in file, {tableAggregates['rows']} in table")
+    for column, columnAggregates in aggregates['columns'].items():
+        for aggregate, value in columnAggregates.items():
+            tableValue = tableAggregates['columns'][column][aggregate]
+            if not(equalAggregate(aggregate, value, tableValue)):
+                differences.append(f"{aggregate} of {column} {value} in file, {tableValue} in table")
+
+    seconds = time.perf_counter() - begin
+    writeMetrics(dict(event='verification', table=table, rows=aggregates['rows'], columns=len(aggregates['columns']),
+                      seconds=round(seconds, 3), differences=differences))
+
+    if len(differences) > 0:
+        print(f"{table}: verification FAILED, {len(differences)} differences with the file:")
+        for difference in differences:
+            print(f"  {difference}")
+        return False
+
+    print(f"{table}: verified {aggregates['rows']} records and {len(aggregates['columns'])} columns in {seconds:.1f} s")
+    return True
+
+# Convert a sav-file with whatever size by reading it in chunks from the offset of its last checkpoint.
+#   The time of the stages is added to timing, if given
+def createTableFromChunksOfSavFile(file, timing=None) -> bool:
     if not(file.endswith('.sav') or file.endswith('.SAV')):
         print(f"File is not a SAV file, abort creation of table.")
         return False
@@ -160,43 +1363,77 @@ def createTableFromChunksOfSavFile(file) -> bool:
     sqlDone = False
 
     try:
-        # Check existence and contents of table
+        # Check existence and contents of table, typed from the metadata catalog
         table = fs.getTableNameFromFileName(file)
+        meta = fs.getMetaDataOfSavFile(file)
         print(f"Tablename {table}")
-        nrTableRecords, currentTableChunk, currentTableResidue = numberTableRecords(table)
 
-        # Compare table contents with SAV file
-        start = (currentTableChunk + 1) * CHUNKSIZE + currentTableResidue
-        df, meta = sav.read_sav(file, row_limit=CHUNKSIZE, row_offset=start)
+        # A staged load inserts into the staging table until it is swapped in
+        loadTable = table
+        if STAGED_LOAD and not(tableExists(table)):
+            loadTable = getStagingTableName(table)
+
+        nrTableRecords = getResumeOffset(loadTable, file)
+        spec = fs.getConversionSpec(file)
+        columnTypes = getColumnTypesOfSavFile(meta, spec)
+
+        # Continue after the last committed chunk
+        start = nrTableRecords
+        nrChunks = 0
+        chunksize = getChunksizeOfSavFile(table, file)
+
+        print(f"{loadTable}: SAV data conversion continued from record {start} ...")
+
+        # Read the next chunk from the sav-file while inserting the current one, if pipelined
+        if timing is None:
+            timing = newStageTiming()
+        chunks = filterChunks(readChunks(file, chunksize, start, meta, fs.getReadColumnsOfConversionSpec(spec, meta)), spec)
+        aggregates = None
+        if VERIFY_LOADS and start == 0:
+            aggregates = newLoadAggregates()
+            chunks = aggregateChunks(chunks, aggregates, columnTypes)
+        elif VERIFY_LOADS:
+            print(f"{loadTable}: not verified, the conversion continued from record {start}")
+        if COMPACT_CHUNKS:
+            chunks = compactChunks(table, chunks, timing)
+        if PIPELINE_DEPTH > 0:
+            chunks = prefetchChunks(chunks, PIPELINE_DEPTH, timing)
+        else:
+            chunks = timeChunks(chunks, timing)
 
-        nrFileRecordsFromStart = df.shape[0]
+        # Convert each dataframe df to sql
+        previous = dict(timing)
+        chunkBegin = time.perf_counter()
+        for df, nrRows in chunks:
+            begin = time.perf_counter()
+            cast = timing['cast']
+            insertChunkWithCheckpoint(loadTable, df, columnTypes, file, start, nrRows, timing=timing)
+            timing['insert'] += time.perf_counter() - begin - (timing['cast'] - cast)
+            chunkBegin = writeChunkMetrics(file, loadTable, start, df, timing, previous, chunkBegin)
 
-        if nrFileRecordsFromStart == 0:
-            print(f"{table}: Conversion already completed containing {currentTableChunk} chunks, and {currentTableResidue} remaining records.")
-            return True
+            start += nrRows
+            nrChunks += 1
 
-        if nrFileRecordsFromStart > currentTableResidue and nrFileRecordsFromStart == CHUNKSIZE and currentTableResidue != 0:
-            print(f"{table}: Number of records in file from start = {nrFileRecordsFromStart} and residue records in table = {currentTableResidue}.")
-            return True
-        
-        print(f"{table}: SAV data conversion continued from chunk {currentTableChunk} ...")
+            print(f"{loadTable}.{str(start)} records exported")
 
-        # Convert dataframe df to sql, and read next chunk from sav-file
-        while df.shape[0] > 0:
-            df.to_sql(table, engine, if_exists='append', index=False, schema='dbo', method=None)
-        
-            print(f"{table}.{str(end)} records exported")
-        
-            start += df.shape[0]
-            
             del df
-            
-            # Read next chunk, if at end, df.shape[0] == 0
-            df, meta = sav.read_sav(file, row_limit=CHUNKSIZE, row_offset=start)
-        
+
+        if nrChunks == 0:
+            print(f"{loadTable}: Conversion already completed containing {nrTableRecords} records.")
+        else:
+            printStageTiming(loadTable, timing)
+
+        if loadTable != table and tableExists(loadTable):
+            swapStagingTable(loadTable, table)
+
+        # A table which differs from its file is dropped, to convert the file again from the start in the next run
+        if aggregates is not None and tableExists(table) and not(verifyTable(table, aggregates)):
+            dropTable(table)
+            print(f"{table}: dropped after its failed verification")
+            return False
+
         sqlDone = True
 
-        del df
         gc.collect()
 
     except Exception as ex:
@@ -211,9 +1448,231 @@ def createTableFromChunksOfSavFile(file) -> bool:
 
     return True
 
+#
+# Partitioned load of oversized files
+#
+#   A sav file above MAX_SAV_FILE_SIZE is divided in row ranges, of the number of rows in its metadata.
+#   PARTITION_WORKERS processes each convert one range at a time into the table {table}PART{n}, in chunks
+#   with checkpoints on the rows of the file, so the memory used depends on the number of workers times the
+#   chunk size instead of on the size of the file. When all ranges are converted, they are merged in order
+#   into the staging table, each range in one transaction together with its checkpoints, and their tables dropped.
+#   The merge inserts into the heap with a table lock, minimally logged like a staged load, so a partitioned load
+#   needs STAGED_LOAD. The staging table is swapped in at the end. The ranges of a file are stored at its start,
+#   a conversion broken off continues on the same ranges.
+#
+
+def partitionedFile(file) -> bool:
+    return PARTITIONED_LOAD and STAGED_LOAD and os.stat(file).st_size > MAX_SAV_FILE_SIZE
+
+def getPartitionTableName(table, index) -> str:
+    return f"{table}PART{index}"
+
+def getRowRanges(nrRows, nrRanges) -> list:
+    size = max(1, -(-nrRows // nrRanges))
+    return [(start, min(start + size, nrRows)) for start in range(0, nrRows, size)]
+
+# The stored ranges of a table as (index, start, end), empty if none are stored
+def getStoredRowRanges(table) -> list:
+    query = select(partitionRanges).where(partitionRanges.c.table_name == table).order_by(partitionRanges.c.range_index)
+    with connections.connect() as connection:
+        return [(row.range_index, row.row_start, row.row_end) for row in connection.execute(query).fetchall()]
+
+def storeRowRanges(table, ranges):
+    with connections.begin() as connection:
+        connection.execute(delete(partitionRanges).where(partitionRanges.c.table_name == table))
+        if len(ranges) > 0:
+            connection.execute(partitionRanges.insert(), [dict(table_name=table, range_index=index, row_start=rangeStart, row_end=rangeEnd)
+                                                          for index, rangeStart, rangeEnd in ranges])
+    return
+
+# A range is merged into the table if the table has a checkpoint in it, as a range is merged as a whole
+def rangeMerged(table, rangeStart, rangeEnd) -> bool:
+    query = select(func.count()).select_from(checkpoints).where(checkpoints.c.table_name == table,
+                                                                checkpoints.c.row_offset >= rangeStart,
+                                                                checkpoints.c.row_offset < rangeEnd)
+    with connections.connect() as connection:
+        return connection.execute(query).scalar() > 0
+
+# Convert the rows rangeStart up to rangeEnd of a sav file into partTable, continued after its last checkpoint.
+#   The result is the number of records converted and the peak memory of the worker
+def convertRangeOfSavFile(file, partTable, rangeStart, rangeEnd):
+    resetPeakMemory()
+    meta = fs.getMetaDataOfSavFile(file)
+    spec = fs.getConversionSpec(file)
+    columnTypes = getColumnTypesOfSavFile(meta, spec)
+    chunksize = getChunksizeOfSavFile(partTable, file)
+
+    start = rangeStart
+    if tableExists(partTable):
+        offset = getCheckpointOffset(partTable, file)
+        if offset is not None:
+            start = offset
+    else:
+        deleteCheckpoints(partTable)
+
+    print(f"{partTable}: SAV data conversion of records {rangeStart} to {rangeEnd} continued from record {start} ...")
+
+    timing = newStageTiming()
+    columns = fs.getReadColumnsOfConversionSpec(spec, meta)
+    chunks = fs.readChunksOfSavFile(file, chunksize, start, rangeEnd - start, usecols=columns) if start < rangeEnd else iter([])
+    chunks = filterChunks(chunks, spec)
+    if COMPACT_CHUNKS:
+        chunks = compactChunks(partTable, chunks, timing)
+    if PIPELINE_DEPTH > 0:
+        chunks = prefetchChunks(chunks, PIPELINE_DEPTH, timing)
+    else:
+        chunks = timeChunks(chunks, timing)
+
+    previous = dict(timing)
+    chunkBegin = time.perf_counter()
+    for df, nrRows in chunks:
+        begin = time.perf_counter()
+        cast = timing['cast']
+        insertChunkWithCheckpoint(partTable, df, columnTypes, file, start, nrRows, timing=timing)
+        timing['insert'] += time.perf_counter() - begin - (timing['cast'] - cast)
+        chunkBegin = writeChunkMetrics(file, partTable, start, df, timing, previous, chunkBegin)
+
+        start += nrRows
+        print(f"{partTable}.{str(start)} records exported")
+
+        del df
+
+    if timing['chunks'] > 0:
+        printStageTiming(partTable, timing)
+
+    return timing['rows'], getMemoryUsage()[1]
+
+# Create the table without rows, with the columns and types of the chunks of the sav file
+def createEmptyTable(table, file, meta):
+    spec = fs.getConversionSpec(file)
+    df, rowMeta = sav.read_sav(file, row_limit=1, usecols=fs.getReadColumnsOfConversionSpec(spec, meta))
+    df = fs.applyConversionSpec(df, spec)
+    insertChunk(table, df.head(0), getColumnTypesOfSavFile(meta, spec))
+    addTableRecords(table, 0)
+    return
+
+# Widen the numeric and string columns of the table to the types of another table, widened in another process
+def widenColumnsToTable(table, other):
+    tableTypes = getColumnTypesOfTable(table)
+    for column, typeName in getColumnTypesOfTable(other).items():
+        current = tableTypes.get(column)
+        if current is None or typeName == current:
+            continue
+        numeric = all(name in INTEGER_RANGES or name == 'FLOAT' for name in [current, typeName])
+        strings = all(fs.getWidthOfSqlColumnType(name) is not None for name in [current, typeName])
+        if numeric or strings:
+            widenColumn(table, column, typeName)
+    return
+
+# Merge the converted ranges into the table in order, each range in one transaction with its checkpoints.
+#   The workers widen the columns of their ranges on their own, the table is widened to each range first.
+def mergeRangesOfSavFile(table, target, file, meta, ranges):
+    if not(tableExists(target)):
+        createEmptyTable(target, file, meta)
+
+    for index, rangeStart, rangeEnd in ranges:
+        partTable = getPartitionTableName(table, index)
+        begin = time.perf_counter()
+        nrRecords = countTableNumberRecords(partTable)
+        widenColumnsToTable(target, partTable)
+
+        with connections.begin() as connection:
+            quote = connection.dialect.identifier_preparer.quote
+            hint = ' WITH (TABLOCK)' if connection.dialect.name == 'mssql' and isStagingTable(target) else ''
+            connection.exec_driver_sql(f"INSERT INTO dbo.{quote(target)}{hint} SELECT * FROM dbo.{quote(partTable)}")
+            connection.execute(checkpoints.update().where(checkpoints.c.table_name == partTable).values(table_name=target))
+            Table(partTable, MetaData(), schema='dbo').drop(connection)
+
+        removeTable(partTable)
+        addTableRecords(target, nrRecords)
+        print(f"{target}: records {rangeStart} to {rangeEnd} merged from {partTable} in {time.perf_counter() - begin:.1f} s")
+
+    return
+
+# Convert an oversized sav file in row ranges, the result is a summary of the conversion like convertSavFile
+def convertSavFileInPartitions(file) -> dict:
+    filesize = os.stat(file).st_size
+    begin = time.perf_counter()
+
+    try:
+        meta = fs.getMetaDataOfSavFile(file)
+    except Exception as ex:
+        print(f"{file} metadata failed: {str(ex)}")
+        return dict(file=file, size=filesize, status='failed', seconds=time.perf_counter() - begin)
+
+    table = meta.table_name
+    target = getStagingTableName(table)
+    nrRows = meta.number_rows if meta.number_rows is not None else -1
+
+    # Continue on the stored ranges of a conversion broken off, or divide the file in new ranges
+    createCheckpointLedger()
+    ranges = getStoredRowRanges(table)
+    partsExist = any(tableExists(getPartitionTableName(table, index)) for index, rangeStart, rangeEnd in ranges)
+    if not(partsExist) and not(tableExists(target)):
+        ranges = getRowRanges(nrRows, max(PARTITION_WORKERS, -(-nrRows // PARTITION_ROWS))) if nrRows > 0 else []
+        ranges = [(index, rangeStart, rangeEnd) for index, (rangeStart, rangeEnd) in enumerate(ranges)]
+
+    # Without the number of rows, or continued from a conversion of the whole file, it is converted as a whole
+    if nrRows <= 0 or tableExists(table) or (tableExists(target) and not(partsExist)):
+        return convertSavFile(file)
+
+    if not(partsExist):
+        storeRowRanges(table, ranges)
+
+    print(f"{str(filesize)} {file} processing in {len(ranges)} ranges of records ...")
+
+    stat = os.stat(file)
+    fingerprint = fs.getFingerprintOfFile(file) if CHANGE_DETECTION else None
+
+    if VERIFY_LOADS:
+        print(f"{table}: not verified, a conversion in ranges of records is not verified")
+
+    if tableExists(target):
+        ranges = [(index, rangeStart, rangeEnd) for index, rangeStart, rangeEnd in ranges if not(rangeMerged(target, rangeStart, rangeEnd))]
+
+    status = 'converted'
+    rows = 0
+    peak = 0
+    with ProcessPoolExecutor(max_workers=PARTITION_WORKERS, initializer=initWorker, initargs=(getWorkerSettings(),)) as pool:
+        futures = {pool.submit(convertRangeOfSavFile, file, getPartitionTableName(table, index), rangeStart, rangeEnd): index
+                   for index, rangeStart, rangeEnd in ranges}
+
+        for future in futures:
+            try:
+                rangeRows, rangePeak = future.result()
+                rows += rangeRows
+                peak = max(peak, rangePeak)
+            except Exception as ex:
+                print(f"{getPartitionTableName(table, futures[future])} conversion failed in worker: {str(ex)}")
+                status = 'failed'
+
+    try:
+        if status == 'converted':
+            mergeRangesOfSavFile(table, target, file, meta, ranges)
+            swapStagingTable(target, table)
+            storeRowRanges(table, [])
+    except Exception as ex:
+        print(f"{table} merge of the ranges failed: {str(ex)}")
+        status = 'failed'
+
+    if status == 'converted' and CHANGE_DETECTION:
+        storeFingerprint(table, file, stat, fingerprint)
+
+    if status == 'converted' and VALUE_LABELS:
+        try:
+            storeValueLabelsOfSavFile(file)
+        except Exception as ex:
+            print(f"{file} value labels failed: {str(ex)}")
+
+    seconds = time.perf_counter() - begin
+    result = dict(file=file, size=filesize, status=status, seconds=seconds, rows=rows, peak_rss_mb=round(peak / 1000000, 1))
+    writeMetrics(dict(event='file', **result))
+
+    return result
+
 # Convert a sav-file with filesize < x GB by reading it in a dataframe at once, 
-#   and convert this dataframe in small chunks to a sql table
-def createTableFromSavFile(file) -> bool:
+#   and convert this dataframe in small chunks to a sql table. The time of the stages is added to timing, if given
+def createTableFromSavFile(file, timing=None) -> bool:
 
     if not(file.endswith('.sav') or file.endswith('.SAV')):
         print(f"File is not a SAV file, abort creation of table.")
@@ -224,41 +1683,47 @@ def createTableFromSavFile(file) -> bool:
     try:
         # Check existence and contents of table
         table = fs.getTableNameFromFileName(file)
+        meta = fs.getMetaDataOfSavFile(file)
         print(f"Tablename {table}")
-        nrTableRecords, currentTableChunk, currentTableResidue = numberTableRecords(table)
+        nrTableRecords = getResumeOffset(table, file)
+        spec = fs.getConversionSpec(file)
+        columnTypes = getColumnTypesOfSavFile(meta, spec)
 
         # Compare table contents with SAV file
-        df, meta = sav.read_sav(file)
+        if timing is None:
+            timing = newStageTiming()
+        begin = time.perf_counter()
+        df, meta = sav.read_sav(file, usecols=fs.getReadColumnsOfConversionSpec(spec, meta))
+        timing['read'] += time.perf_counter() - begin
 
         nrFileRecords = df.shape[0]
-        nrFileChunks = nrFileRecords // CHUNKSIZE
-        nrFileResidue = nrFileRecords % CHUNKSIZE
 
-        if currentTableChunk == nrFileChunks and currentTableResidue == nrFileResidue:
-            print(f"{table}: Conversion already completed containing {currentTableChunk} chunks, and {currentTableResidue} remaining records.")
+        if nrTableRecords >= nrFileRecords:
+            print(f"{table}: Conversion already completed containing {nrTableRecords} records.")
             return True
 
-        if currentTableResidue != 0:
-            print(f"{table}: Number of records in table {nrTableRecords} and file {nrFileRecords} not equal.")
-            return True
-        
-        print(f"{table}: SAV data conversion continued from chunk {currentTableChunk} ...")
+        print(f"{table}: SAV data conversion continued from record {nrTableRecords} ...")
 
-        # Convert SAV to SQL in chunks
-        chunk = -1
-        for chunk in range(currentTableChunk, nrFileChunks):
-            start = chunk * CHUNKSIZE
-            end = start + CHUNKSIZE
+        # Convert SAV to SQL in chunks, from the first record not in the table
+        if ADAPTIVE_CHUNKSIZE:
+            chunksize = getChunksizeOfRowSize(df.memory_usage(deep=True).sum() / max(nrFileRecords, 1))
+        else:
+            chunksize = CHUNKSIZE
 
-            df[start: end].to_sql(table, engine, if_exists='append', index=False, schema='dbo', method=None)
-            print(f"{table}.{str(end)} records exported")
+        previous = dict(timing)
+        chunkBegin = time.perf_counter()
+        for start in range(nrTableRecords, nrFileRecords, chunksize):
+            end = min(start + chunksize, nrFileRecords)
 
-        chunk += 1
-        start = chunk * CHUNKSIZE
-        end = start + nrFileResidue
+            chunk = fs.applyConversionSpec(df[start: end], spec)
 
-        df[start: end].to_sql(table, engine, if_exists='append', index=False, schema='dbo', method=None)
-        print(f"{table}.{nrFileResidue} remaining records exported")
+            begin = time.perf_counter()
+            cast = timing['cast']
+            insertChunkWithCheckpoint(table, chunk, columnTypes, file, start, end - start, timing=timing)
+            timing['insert'] += time.perf_counter() - begin - (timing['cast'] - cast)
+            chunkBegin = writeChunkMetrics(file, table, start, chunk, timing, previous, chunkBegin)
+
+            print(f"{table}.{str(end)} records exported")
 
         sqlDone = True
 
@@ -278,15 +1743,87 @@ def createTableFromSavFile(file) -> bool:
 
     return True
 
+#
+# Convert a csv-file by streaming it in blocks of records straight into the table, parsed by the C engine
+# of pandas. Each chunk is checkpointed with the byte position after it, so the conversion continues
+# from that position in the file. The time of the stages is added to timing, if given.
+#
+def createTableFromCsvFile(file, timing=None) -> bool:
+    if not(file.lower().endswith('.csv')):
+        print(f"File is not a CSV file, abort creation of table.")
+        return False
+
+    sqlDone = False
+
+    try:
+        table = fs.getTableNameFromFileName(file)
+        print(f"Tablename {table}")
+
+        if tableExists(table):
+            start, byteOffset = getCheckpointOffsets(table, file)
+            if start is None:
+                print(f"{table} already exists without checkpoints, drop the table to convert {file} again.")
+                return True
+        else:
+            deleteCheckpoints(table)
+            start, byteOffset = 0, 0
+
+        print(f"{table}: CSV data conversion continued from record {start} ...")
+
+        columnTypes = getColumnTypesOfCsvFile(file)
+
+        nrChunks = 0
+        if timing is None:
+            timing = newStageTiming()
+        chunks = timeChunks(fs.readChunksOfCsvFile(file, byteOffset), timing)
+
+        previous = dict(timing)
+        chunkBegin = time.perf_counter()
+        for df, byteEnd in chunks:
+            begin = time.perf_counter()
+            cast = timing['cast']
+            insertChunkWithCheckpoint(table, df, columnTypes, file, start, df.shape[0], byteEnd, timing)
+            timing['insert'] += time.perf_counter() - begin - (timing['cast'] - cast)
+            chunkBegin = writeChunkMetrics(file, table, start, df, timing, previous, chunkBegin)
+
+            start += df.shape[0]
+            nrChunks += 1
+
+            print(f"{table}.{str(start)} records exported")
+
+            del df
+
+        if nrChunks == 0:
+            print(f"{table}: Conversion already completed containing {start} records.")
+        else:
+            printStageTiming(table, timing)
+
+        sqlDone = True
+
+        gc.collect()
+
+    except Exception as ex:
+
+        gc.collect()
+
+        if(sqlDone == False):
+            print(f"{table} export failed: {str(ex)}")
+            return False
+
+        return False
+
+    return True
+
 # General function independent of conversion route, depreciated
 def createTableFromFile(file) -> bool:
 
+    # CSV files are streamed into their table
+    if file.endswith('.csv'):
+        return createTableFromCsvFile(file)
+
     savDone = False
     sqlDone = False
 
-    currentChunknr = 0
-    nrTableRecords = -1    # table does not exists
-
     try:
         table = fs.getTableNameFromFileName(file)
 
@@ -296,63 +1833,24 @@ def createTableFromFile(file) -> bool:
 
             # If not completed because number of records have integer factor of CHUNKSIZE (could be zero)
             if  nrTableRecords % CHUNKSIZE == 0:
-                currentChunknr = nrTableRecords//CHUNKSIZE
-                
-                if file.endswith('.sav'):
-                    print(f"{table} already exists: sav data conversion restarted and will replace existing table data ...")
-                
-                if file.endswith('.csv'):
-                    print(f"{table} already exists: csv data conversion continued from chunk {currentChunknr} ...")
-
-                #nrTableRecords = 0
-                #dropTable(table)
+                print(f"{table} already exists: sav data conversion restarted and will replace existing table data ...")
 
             # If completed
             else:
                 print(f"{table} already exists and conversion completed containing {nrTableRecords} records.")
                 return True
 
-        # CSV file processing, split in chunks first
-        if file.endswith('.csv'):
-
-            # Split in chunk files if table does not exists
-            if nrTableRecords == -1:
-                createChunkCsvFiles(table,file)
-                savDone = True
-
-            # Process the chunk files
-            else:
-                savDone = False
-                sqlDone = False
-                lastChunknr = fs.lastChunknrCsvFile(table)
-                for chunknr in range(currentChunknr, lastChunknr + 1):
-                    chunk = pd.read_csv(f"{table}.{str(chunknr)}", engine='python')
-                    print(f"{table}.{str(chunknr)} imported: {str(chunk.shape[0])}")
-                    savDone = True
-                    sqlDone = False
-
-                    chunk.to_sql(table, engine, if_exists='append', index=False, schema='dbo', method=None, chunksize=100000)
-                    del chunk
-                    gc.collect()
-                    print(f"{table}.{str(chunknr)} exported")
-                    sqlDone = True
-                    savDone = False
-                    os.remove(f"{table}.{chunknr}")
-
-                    chunknr += 1
-
-                savDone = True
-
         # SAV file processing
-        else:
-            df = pd.read_spss(file)
+        df = pd.read_spss(file)
 
-            print(f"{table} imported: {str(len(df))}")
-            savDone = True
+        print(f"{table} imported: {str(len(df))}")
+        savDone = True
 
-            df.to_sql(table, engine, if_exists='replace', index=False, schema='dbo', method=None) #, chunksize=100000)
-            print(f"{table} exported")
-            sqlDone = True
+        df.to_sql(table, connections.engine, if_exists='replace', index=False, schema='dbo', method=None) #, chunksize=100000)
+        removeTable(table)
+        addTableRecords(table, df.shape[0])
+        print(f"{table} exported")
+        sqlDone = True
 
     except Exception as ex:
 
@@ -393,35 +1891,584 @@ def createTableFromFile(file) -> bool:
 #  > import database as db
 #  > db.runSavToSQL("accessible_files_proposal.txt")
 #
-def runSavToSQL(filelist):
+def runSavToSQL(filelist, maxWorkers=None, loader=None):
+    global LOADER
 
     files = fs.readFiles(filelist)
 
-    nrFilesSuccessFull = 0
-    nrFilesFailed = 0
-    nrFilesSkipped = 0
+    if loader is not None:
+        LOADER = loader
+
+    if maxWorkers is None:
+        maxWorkers = MAX_WORKERS
+
+    startRunMetrics()
+
+    if PARTITIONED_LOAD and not(STAGED_LOAD):
+        print(f"PARTITIONED_LOAD needs STAGED_LOAD, files above MAX_SAV_FILE_SIZE are not converted in partitions")
+
+    if STAGED_LOAD and LOADER != 'bcp':
+        print(f"STAGED_LOAD with LOADER '{LOADER}': the inserts are fully logged, use LOADER 'bcp' for a small transaction log")
+
+    createCheckpointLedger()
+    if VALUE_LABELS:
+        createValueLabelTables()
+
+    results = []
+    files = selectChangedFiles(files, results)
+    printConversionPlan(files)
+
+    if maxWorkers > 1:
+        # Oversized files are converted one at a time, each by its own pool of workers
+        results += [convertSavFileInPartitions(file) for file in files if partitionedFile(file)]
+        results += runSavToSQLInParallel([file for file in files if not(partitionedFile(file))], maxWorkers, MAX_SAV_FILE_SIZE)
+        printConversionSummary(results)
+        if BUILD_INDEXES:
+            buildIndexesOfFiles([result['file'] for result in results if result['status'] == 'converted'])
+        if FAMILY_TABLES:
+            createFamilyViews(files)
+        printRunReport(results)
+        return
 
     for file in files:
 
         filesize = os.stat(file).st_size  # Measure the filesize in bytes
 
-        if filesize > MAX_SAV_FILE_SIZE:
-            print(f"{str(os.stat(file).st_size)} {file} too big, file needs manual conversion, skipping ...")
-            nrFilesSkipped += 1
+        if partitionedFile(file):
+            results.append(convertSavFileInPartitions(file))
+            printConversionCounters(results)
+            continue
+
+        if filesize > MAX_SAV_FILE_SIZE and not(STAGED_LOAD):
+            print(f"{str(filesize)} {file} too big, file needs manual conversion, STAGED_LOAD or PARTITIONED_LOAD, skipping ...")
+            results.append(dict(file=file, size=filesize, status='skipped', seconds=0.0))
+            continue
+
+        results.append(convertSavFile(file))
+
+        printConversionCounters(results)
+
+    printConversionSummary(results)
+    if BUILD_INDEXES:
+        buildIndexesOfFiles([result['file'] for result in results if result['status'] == 'converted'])
+    if FAMILY_TABLES:
+        createFamilyViews(files)
+    printRunReport(results)
+
+    return
+
+#
+# Value labels
+#
+
+def createValueLabelTables():
+    global valueLabelTablesCreated
+    if not(valueLabelTablesCreated):
+        valueLabelSetKeys.create(connections.engine, checkfirst=True)
+        valueLabelSets.create(connections.engine, checkfirst=True)
+        valueLabelVariables.create(connections.engine, checkfirst=True)
+        valueLabelTablesCreated = True
+    return
+
+# The hash of a set of value labels, the same for the same type of codes, codes and labels in any order
+def getHashOfValueLabels(labels, numeric) -> str:
+    pairs = sorted([str(code), str(label)] for code, label in labels.items())
+    return hashlib.sha1(json.dumps([numeric, pairs]).encode('utf-8')).hexdigest()
+
+# Store a set of value labels, unless stored before by this or another process. True if new.
+def storeValueLabelSet(labelSet, labels, numeric) -> bool:
+    with connections.connect() as connection:
+        query = select(func.count()).select_from(valueLabelSets).where(valueLabelSets.c.label_set == labelSet)
+        if connection.execute(query).scalar() > 0:
+            return False
+
+    rows = [dict(label_set=labelSet, code_number=float(code) if numeric else None,
+                 code_string=None if numeric else str(code), label=str(label)) for code, label in labels.items()]
+    try:
+        with connections.begin() as connection:
+            connection.execute(valueLabelSetKeys.insert(), dict(label_set=labelSet, numeric_codes=numeric, number_labels=len(rows)))
+            connection.execute(valueLabelSets.insert(), rows)
+    except IntegrityError:
+        return False
+
+    return True
+
+# Store the value labels of the columns of the table of a sav file, kept by its conversion spec
+def storeValueLabelsOfSavFile(file):
+    createValueLabelTables()
+
+    meta = fs.getMetaDataOfSavFile(file)
+    table = meta.table_name
+    columns = fs.getColumnsOfConversionSpec(fs.getConversionSpec(file), meta)
+
+    variables = []
+    nrNewSets = 0
+    for column in columns:
+        labels = meta.variable_value_labels.get(column)
+        if not(labels):
+            continue
+
+        numeric = meta.readstat_variable_types[column] == 'double'
+        labelSet = getHashOfValueLabels(labels, numeric)
+        if storeValueLabelSet(labelSet, labels, numeric):
+            nrNewSets += 1
+        variables.append(dict(table_name=table, column_name=column, label_set=labelSet, numeric_codes=numeric))
+
+    with connections.begin() as connection:
+        connection.execute(delete(valueLabelVariables).where(valueLabelVariables.c.table_name == table))
+        if len(variables) > 0:
+            connection.execute(valueLabelVariables.insert(), variables)
+
+    print(f"{table}: value labels of {len(variables)} columns stored, {nrNewSets} new label sets")
+    return
+
+#
+# Create the view {table}LABELS of a table with its value labels stored: all its columns, and after each
+# labelled column its label in the column {column}_LABEL. Labels are joined when read, the table keeps the codes.
+#
+def createLabelledView(table):
+    with connections.connect() as connection:
+        variables = connection.execute(select(valueLabelVariables).where(valueLabelVariables.c.table_name == table)).fetchall()
+
+    labelled = {variable.column_name: variable for variable in variables}
+    view = f"{table}LABELS"
+
+    with connections.begin() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        columns = []
+        joins = []
+        for column in [column['name'] for column in inspect(connection).get_columns(table, schema='dbo')]:
+            columns.append(f"T.{quote(column)}")
+            if column not in labelled:
+                continue
+
+            alias = f"L{len(joins)}"
+            code = 'code_number' if labelled[column].numeric_codes else 'code_string'
+            columns.append(f"{alias}.label AS {quote(column + '_LABEL')}")
+            joins.append(f"LEFT JOIN dbo.{valueLabelSets.name} {alias} ON {alias}.label_set = '{labelled[column].label_set}' "
+                         f"AND {alias}.{code} = T.{quote(column)}")
+
+        connection.exec_driver_sql(f"DROP VIEW IF EXISTS dbo.{quote(view)}")
+        connection.exec_driver_sql(f"CREATE VIEW dbo.{quote(view)} AS SELECT {', '.join(columns)} "
+                                   f"FROM dbo.{quote(table)} T {' '.join(joins)}")
+
+    print(f"{view}: view of {table} with the labels of {len(joins)} columns")
+    return
+
+#
+# Families of yearly and versioned tables
+#
+#   The files of a family, like GBASCHEIDINGENMASSATAB 2013V1.sav and 2014V1.sav, are converted each into their
+#   own table, in parallel like any other files. The view {family}FAMILY_ combines the converted tables of the
+#   family in one, with the columns YEAR and VERSION first: a partitioned view, of which SQL Server only reads
+#   the tables of the years queried. The columns of all years are in the view, cast to the type holding the
+#   values of all years, from the columns of the tables as loaded; columns missing in a year are NULL.
+#   A new year is appended by converting its file and creating the view again, the other tables are not touched.
+#
+
+def getFamilyViewName(family) -> str:
+    return f"{family}FAMILY_"
+
+# The converted tables of a family with their column types, ordered by year and version
+def getMembersOfFamily(family) -> list:
+    members = []
+    for path, table in fs.getCatalogedFilesOfFamily(family):
+        if not(tableExists(table)) or not(os.path.exists(path)):
             continue
 
-        print(f"{str(os.stat(file).st_size)} {file} processing ...")
+        # The types of the columns as loaded, these may be wider than in the catalog
+        tableFamily = fs.getFamilyOfTableName(table)
+        members.append(SimpleNamespace(table=table, year=tableFamily.year, version=tableFamily.version,
+                                       columnTypes=getColumnTypesOfTable(table)))
+
+    members.sort(key=lambda member: (member.year, member.version or 0))
+    return members
+
+# Create the view of a family over its converted tables, with the column types reconciled over the years
+def createFamilyView(family):
+    members = getMembersOfFamily(family)
+    if len(members) == 0:
+        print(f"{family}: no converted tables of the family")
+        return
+
+    # The columns in order of first appearance, with the type holding the values of all years
+    columns = {}
+    for member in members:
+        for column, columnType in member.columnTypes.items():
+            columns.setdefault(column, []).append(columnType)
+    columnTypes = {column: fs.getWidestSqlColumnType(types) for column, types in columns.items()}
+
+    view = getFamilyViewName(family)
+    with connections.begin() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        selects = []
+        for member in members:
+            version = 'NULL' if member.version is None else str(member.version)
+            fields = [f"CAST({member.year} AS SMALLINT) AS YEAR", f"CAST({version} AS SMALLINT) AS VERSION"]
+            for column, columnType in columnTypes.items():
+                if column not in member.columnTypes:
+                    fields.append(f"CAST(NULL AS {columnType}) AS {quote(column)}")
+                elif member.columnTypes[column] != columnType:
+                    fields.append(f"CAST({quote(column)} AS {columnType}) AS {quote(column)}")
+                else:
+                    fields.append(quote(column))
+            selects.append(f"SELECT {', '.join(fields)} FROM dbo.{quote(member.table)}")
+
+        connection.exec_driver_sql(f"DROP VIEW IF EXISTS dbo.{quote(view)}")
+        connection.exec_driver_sql(f"CREATE VIEW dbo.{quote(view)} AS {' UNION ALL '.join(selects)}")
+
+    reconciled = [column for column, types in columns.items() if len(types) < len(members) or len(set(types)) > 1]
+    print(f"{view}: view of {len(members)} tables from {members[0].year} to {members[-1].year}, "
+          f"{len(columnTypes)} columns of which {len(reconciled)} reconciled over the years")
+    return
 
-        if createTableFromChunksOfSavFile(file): #createTableFromSavFile(file):
-            nrFilesSuccessFull += 1
+# Create the views of the families of the tables of the files, with the tables converted by the workers
+def createFamilyViews(files):
+    getTableSnapshot(refresh=True)
 
+    families = []
+    for file in files:
+        tableFamily = fs.getFamilyOfTableName(fs.getTableNameFromFileName(file))
+        if tableFamily is not None and tableFamily.family not in families:
+            families.append(tableFamily.family)
+
+    for family in families:
+        try:
+            createFamilyView(family)
+        except Exception as ex:
+            print(f"{getFamilyViewName(family)} view failed: {str(ex)}")
+
+    return
+
+#
+# Change detection of the source files
+#
+
+# The stored fingerprints of the tables, by table name
+def getStoredFingerprints() -> dict:
+    createCheckpointLedger()
+    with connections.connect() as connection:
+        return {row.table_name: row for row in connection.execute(select(fingerprints)).fetchall()}
+
+# Store the fingerprint of the file of a table, taken before its conversion
+def storeFingerprint(table, file, stat, fingerprint):
+    row = dict(table_name=table, file=file, file_size=stat.st_size, file_mtime=stat.st_mtime,
+               fingerprint=fingerprint, converted_at=datetime.datetime.now())
+    with connections.begin() as connection:
+        connection.execute(delete(fingerprints).where(fingerprints.c.table_name == table))
+        connection.execute(fingerprints.insert(), row)
+    return
+
+#
+# The change of a file since the conversion of its table:
+#   new        no completed conversion, converted or continued from its checkpoints
+#   unchanged  the same size and modification time
+#   touched    another modification time but the same fingerprint, its modification time is updated
+#   changed    another fingerprint, or the file of the table was replaced by another file
+#
+def getChangeOfSavFile(file, table, stored) -> str:
+    if table not in stored:
+        return 'new'
+
+    row = stored[table]
+    stat = os.stat(file)
+    if row.file == file and row.file_size == stat.st_size and row.file_mtime == stat.st_mtime:
+        return 'unchanged'
+
+    if row.file_size != stat.st_size or fs.getFingerprintOfFile(file) != row.fingerprint:
+        return 'changed'
+
+    if row.file == file:
+        with connections.begin() as connection:
+            connection.execute(fingerprints.update().where(fingerprints.c.table_name == table).values(file_mtime=stat.st_mtime))
+        return 'touched'
+
+    return 'changed'
+
+#
+# The files of a run to convert: the new and changed files. The tables of changed files are dropped, to be converted
+# again from the start. The unchanged files are added to the results as unchanged, and the changes are reported.
+#
+def selectChangedFiles(files, results) -> list:
+    if not(CHANGE_DETECTION):
+        return files
+
+    stored = getStoredFingerprints()
+    changes = {}
+    selected = []
+    for file in files:
+        table = fs.getTableNameFromFileName(file)
+        change = getChangeOfSavFile(file, table, stored)
+        changes.setdefault(change, []).append(file)
+
+        if change in ['unchanged', 'touched']:
+            results.append(dict(file=file, size=os.stat(file).st_size, status='unchanged', seconds=0.0))
+            continue
+
+        if change == 'changed':
+            print(f"{file} changed since the conversion of {table}, converting it again ...")
+            if tableExists(table):
+                dropTable(table)
+            else:
+                deleteCheckpoints(table)
+
+        selected.append(file)
+
+    writeMetrics(dict(event='changes', **{change: len(changed) for change, changed in changes.items()}))
+    print(f"Files new: {len(changes.get('new', []))}, changed: {len(changes.get('changed', []))}, "
+          f"unchanged: {len(changes.get('unchanged', []))}, only modification time changed: {len(changes.get('touched', []))}")
+
+    return selected
+
+#
+# Indexes of the converted tables
+#
+#   After the loads the tables get the physical design for the joins on person and household keys, from the
+#   metadata catalog: the key columns are the columns of KEY_COLUMN_PATTERN. Wide tables with many rows get a
+#   clustered columnstore index, other tables a clustered index on the first column of CLUSTERED_KEY_COLUMNS,
+#   and the other key columns a nonclustered index. A key with a source code column, like RINPERSOONS with
+#   RINPERSOON, is indexed on the pair, as it is joined on; a source code column has a few values only. Indexes
+#   of a table built before, like the clustered index of a staged load, are kept. INDEX_WORKERS tables are
+#   indexed at the same time.
+#
+
+# The indexes to build on the table of a sav file: the name, kind (columnstore, clustered, nonclustered) and columns of each
+def getIndexPlanOfSavFile(file) -> list:
+    meta = fs.getMetaDataOfSavFile(file)
+    table = meta.table_name
+    columns = fs.getColumnsOfConversionSpec(fs.getConversionSpec(file), meta)
+    columnTypes = fs.getSqlColumnTypes(meta)
+
+    keys = [column for column in columns if KEY_COLUMN_PATTERN.match(column) and columnTypes[column] != 'VARCHAR(max)']
+    sources = {column[:-1]: column for column in keys if column[-1:].upper() == 'S' and column[:-1] in keys}
+    keys = [column for column in keys if column not in sources.values()]
+    indexColumns = {column: [sources[column], column] if column in sources else [column] for column in keys}
+    clusteredKeys = [column for column in CLUSTERED_KEY_COLUMNS if column in keys][:1] or keys[:1]
+
+    plan = []
+    wide = len(columns) >= COLUMNSTORE_MIN_COLUMNS and (meta.number_rows or 0) >= COLUMNSTORE_MIN_ROWS
+    if wide and connections.engine.dialect.name == 'mssql':
+        plan.append((f"CCI_{table}", 'columnstore', []))
+        plan += [(f"IX_{table}_{column}", 'nonclustered', indexColumns[column]) for column in keys]
+    elif len(clusteredKeys) > 0:
+        plan.append((f"CIX_{table}", 'clustered', indexColumns[clusteredKeys[0]]))
+        plan += [(f"IX_{table}_{column}", 'nonclustered', indexColumns[column]) for column in keys if column not in clusteredKeys]
+
+    return plan
+
+# Build the planned indexes of a table which it does not have yet, the result is a summary with the time of each build
+def buildIndexesOfTable(table, plan) -> dict:
+    # A table has one clustered index, of any name or as its primary key. Other databases have none, only the names built here.
+    with connections.connect() as connection:
+        existing = [index['name'] for index in inspect(connection).get_indexes(table, schema='dbo')]
+        if connection.dialect.name == 'mssql':
+            clusteredIndexes = [row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM sys.indexes WHERE object_id = OBJECT_ID(?) AND type IN (1, 5)", (f"dbo.{table}",))]
+            existing += clusteredIndexes
+            clustered = len(clusteredIndexes) > 0
         else:
-            nrFilesFailed += 1
+            clustered = any(name.startswith('CIX_') or name.startswith('CCI_') for name in existing)
 
-        print(f"Files successfully converted:  {nrFilesSuccessFull}")
-        print(f"Files failed when converted:   {nrFilesFailed}")
-        print(f"Files skipped when converted:  {nrFilesSkipped}")
+    builds = []
+    for name, kind, indexColumns in plan:
+        if name in existing or (kind != 'nonclustered' and clustered):
+            continue
 
+        if kind == 'columnstore':
+            begin = time.perf_counter()
+            with connections.begin() as connection:
+                connection.exec_driver_sql(f"CREATE CLUSTERED COLUMNSTORE INDEX [{name}] ON [dbo].[{table}]")
+            seconds = time.perf_counter() - begin
+        else:
+            seconds = buildIndex(table, name, indexColumns, clustered=(kind == 'clustered'))
+
+        builds.append(dict(index=name, kind=kind, columns=indexColumns, seconds=round(seconds, 1)))
+        print(f"{table}: {kind} index {name} {'on ' + ', '.join(indexColumns) + ' ' if indexColumns else ''}built in {seconds:.1f} s")
+
+    return dict(table=table, builds=builds)
+
+# Build the indexes of the tables of the files, INDEX_WORKERS tables at the same time
+def buildIndexesOfFiles(files):
+    getTableSnapshot(refresh=True)
+
+    plans = {}
+    for file in files:
+        table = fs.getTableNameFromFileName(file)
+        if tableExists(table):
+            plans[table] = getIndexPlanOfSavFile(file)
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+        futures = {pool.submit(buildIndexesOfTable, table, plan): table for table, plan in plans.items() if len(plan) > 0}
+        for future in futures:
+            try:
+                result = future.result()
+                writeMetrics(dict(event='index', **result))
+            except Exception as ex:
+                print(f"{futures[future]} index build failed: {str(ex)}")
+
+    print(f"Indexes of {len(futures)} tables built in {time.perf_counter() - begin:.1f} s")
     return
 
+# Convert one sav file, the result is a summary of the conversion of this file
+def convertSavFile(file) -> dict:
+
+    filesize = os.stat(file).st_size
+
+    print(f"{str(filesize)} {file} processing ...")
+
+    timing = newStageTiming()
+    begin = time.perf_counter()
+    resetPeakMemory()
+    stat = os.stat(file)
+    fingerprint = fs.getFingerprintOfFile(file) if CHANGE_DETECTION else None
+    converted = createTableFromChunksOfSavFile(file, timing) #createTableFromSavFile(file)
+    if converted and CHANGE_DETECTION:
+        storeFingerprint(fs.getTableNameFromFileName(file), file, stat, fingerprint)
+    if converted and VALUE_LABELS:
+        try:
+            storeValueLabelsOfSavFile(file)
+        except Exception as ex:
+            print(f"{file} value labels failed: {str(ex)}")
+    seconds = time.perf_counter() - begin
+
+    result = dict(file=file, size=filesize, status='converted' if converted else 'failed', seconds=seconds)
+    result.update(getStageMetrics(newStageTiming(), timing, seconds, filesize))
+    writeMetrics(dict(event='file', **result))
+
+    return result
+
+def getWorkerSettings() -> dict:
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    settings['filesSettings'] = {name: getattr(fs, name) for name in FILES_WORKER_SETTINGS}
+    return settings
+
+# Start of a worker process: take over the settings of the main process and of files.py, its engine is created on first use
+def initWorker(settings):
+    settings = dict(settings)
+    for name, value in settings.pop('filesSettings').items():
+        setattr(fs, name, value)
+    globals().update(settings)
 
+    return
+
+#
+# Convert the sav files with a pool of maxWorkers processes. The largest files are started first,
+# and a file is only started if the sum of the sizes of the running files fits in maxMemory,
+# because the size of a file represents almost the required size of RAM. The largest pending
+# file always starts when no other file is running.
+#
+def runSavToSQLInParallel(files, maxWorkers, maxMemory) -> list:
+
+    results = []
+    pending = []
+
+    for file in files:
+        filesize = os.stat(file).st_size
+
+        if filesize > MAX_SAV_FILE_SIZE and not(STAGED_LOAD):
+            print(f"{str(filesize)} {file} too big, file needs manual conversion, STAGED_LOAD or PARTITIONED_LOAD, skipping ...")
+            results.append(dict(file=file, size=filesize, status='skipped', seconds=0.0))
+            continue
+
+        pending.append((filesize, file))
+
+    pending.sort(reverse=True)
+
+    with ProcessPoolExecutor(max_workers=maxWorkers, initializer=initWorker, initargs=(getWorkerSettings(),)) as pool:
+
+        running = {}
+        memory = 0
+
+        while pending or running:
+
+            # Schedule the largest pending files which fit in the free workers and memory
+            for filesize, file in list(pending):
+                if len(running) >= maxWorkers:
+                    break
+                if memory + filesize <= maxMemory or len(running) == 0:
+                    running[pool.submit(convertSavFile, file)] = (filesize, file)
+                    memory += filesize
+                    pending.remove((filesize, file))
+
+            done, notDone = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                filesize, file = running.pop(future)
+                memory -= filesize
+
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    print(f"{file} conversion failed in worker: {str(ex)}")
+                    results.append(dict(file=file, size=filesize, status='failed', seconds=0.0))
+
+            printConversionCounters(results)
+
+    return results
+
+# The plan of a run from one snapshot of the tables in the database, instead of a query per file
+def printConversionPlan(files):
+    snapshot = getTableSnapshot(refresh=True)
+
+    existing = [fs.getTableNameFromFileName(file).upper() for file in files]
+    existing = [table for table in existing if table in snapshot]
+
+    print(f"{len(files)} files to convert: {len(files) - len(existing)} new tables, "
+          f"{len(existing)} tables already in the database with about {sum(snapshot[table] for table in existing)} records")
+    return
+
+def printConversionCounters(results):
+    print(f"Files successfully converted:  {sum(1 for result in results if result['status'] == 'converted')}")
+    print(f"Files failed when converted:   {sum(1 for result in results if result['status'] == 'failed')}")
+    print(f"Files skipped when converted:  {sum(1 for result in results if result['status'] == 'skipped')}")
+    print(f"Files unchanged, not converted: {sum(1 for result in results if result['status'] == 'unchanged')}")
+    return
+
+# Start a new run in the METRICS_FILE
+def startRunMetrics():
+    global METRICS_RUN
+    global runBegin
+
+    METRICS_RUN = datetime.datetime.now().isoformat(timespec='seconds')
+    runBegin = time.perf_counter()
+    return
+
+#
+# The report of a run, to size the virtual machine and to compare runs: the time of each stage over all
+# files, the throughput and the largest peak memory of a conversion. Written as the last record of the run.
+#
+def printRunReport(results):
+    seconds = time.perf_counter() - runBegin
+    converted = [result for result in results if result['status'] == 'converted']
+
+    report = dict(event='run', files=len(results), converted=len(converted),
+                  failed=sum(1 for result in results if result['status'] == 'failed'),
+                  skipped=sum(1 for result in results if result['status'] == 'skipped'),
+                  unchanged=sum(1 for result in results if result['status'] == 'unchanged'),
+                  seconds=round(seconds, 1), rows=sum(result.get('rows', 0) for result in results),
+                  gigabytes=round(sum(result['size'] for result in converted) / 1000000000, 3))
+    for stage in ['read_s', 'transform_s', 'insert_s']:
+        report[stage] = round(sum(result.get(stage, 0.0) for result in results), 1)
+    report['rows_per_s'] = round(report['rows'] / seconds, 1) if seconds > 0 else None
+    report['mb_per_s'] = round(report['gigabytes'] * 1000 / seconds, 2) if seconds > 0 else None
+    report['peak_rss_mb'] = max([result.get('peak_rss_mb', 0.0) for result in results] + [0.0])
+    writeMetrics(report)
+
+    busy = report['read_s'] + report['transform_s'] + report['insert_s']
+    print(f"\nRun {METRICS_RUN}: {report['converted']} files, {report['rows']} records, {report['gigabytes']} GB in {report['seconds']} s, "
+          f"{report['rows_per_s']} records/s, {report['mb_per_s']} MB/s")
+    if busy > 0:
+        print(f"Stages: read {report['read_s']} s ({100*report['read_s']/busy:.0f}%), transform {report['transform_s']} s "
+              f"({100*report['transform_s']/busy:.0f}%), insert {report['insert_s']} s ({100*report['insert_s']/busy:.0f}%)")
+    print(f"Peak memory of a conversion: {report['peak_rss_mb']/1000:.2f} GB")
+    if METRICS_FILE is not None:
+        print(f"Metrics of the chunks and files in {METRICS_FILE}")
+    return
+
+def printConversionSummary(results):
+    print("\n")
+    for result in results:
+        print(f"{result['status']:<10} {result['seconds']:>10.1f} s {result['size']/1000000000:>8.3f} GB  {result['file']}")
+    printConversionCounters(results)
+    return
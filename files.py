@@ -38,16 +38,85 @@
 
 import os
 import os.path
+import io
+import csv
+import json
+import codecs
+import time
+import glob
+import fnmatch
+import hashlib
+import sqlite3
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
+import re
+import pandas as pd
 import pyreadstat as sav
 import string
 
+# pyarrow is optional, only needed for the Parquet cache of sav files
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 #
 # Package startup code
 #
 # The size of a file in bytes represents almost the required size of RAM assigned to the virtual machine
 MAX_FILE_SIZE = 32000000000  # 32 Gigabytes 
 
+global DISCOVERY_WORKERS
+DISCOVERY_WORKERS = 16           # The number of directories scanned at the same time, mostly waiting on the network drive
+
+global MANIFEST_FILE
+MANIFEST_FILE = 'files_manifest.json'  # Cache of the directories and accessible files found by createFileOfExtensionFiles
+
+global METADATA_CATALOG
+METADATA_CATALOG = 'metadata_catalog.db'  # SQLite catalog of the metadata of the sav files, keyed by path, size and mtime
+
+global METADATA_WORKERS
+METADATA_WORKERS = 4             # The number of sav files of which the metadata is read at the same time
+
+global PARQUET_CACHE_FOLDER
+PARQUET_CACHE_FOLDER = 'parquet_cache'  # Local folder of the Parquet copies of converted sav files
+
+global PARQUET_CACHE_BUDGET
+PARQUET_CACHE_BUDGET = 200000000000  # 200 Gigabyte, the least recently used Parquet files are removed above this size
+
+global CONVERSION_SPECS
+CONVERSION_SPECS = 'conversion_specs.json'  # The columns to keep and the row filters per file or pattern of file names
+
+global FINGERPRINT_BLOCKS
+FINGERPRINT_BLOCKS = 8           # The number of blocks of a file hashed in its fingerprint, besides its header and last block
+
+global FINGERPRINT_BLOCK_BYTES
+FINGERPRINT_BLOCK_BYTES = 65536  # The number of bytes of each block hashed in the fingerprint of a file
+
+global CSV_CHUNK_BYTES
+CSV_CHUNK_BYTES = 256000000      # The number of bytes of a csv file parsed in one chunk
+
+global CSV_SAMPLE_BYTES
+CSV_SAMPLE_BYTES = 1000000       # The number of bytes at the start of a csv file sniffed for its dialect and schema
+
+global CSV_TYPE_HEADROOM
+CSV_TYPE_HEADROOM = 100          # Integer ranges found in a partial sample are widened by this factor, string widths are doubled
+
+# The delimiters recognised in csv files
+CSV_DELIMITERS = ',;\t|'
+
+# String columns up to this width are stored as CHAR(n), wider ones as VARCHAR(n)
+FIXED_CHAR_WIDTH = 16
+
+# SPSS formats converted by pyreadstat to dates, datetimes and times, as in its spss_date_formats,
+# spss_datetime_formats and spss_time_formats. DTIME (days and time) is read as a time of day.
+DATE_FORMATS = ['DATE', 'ADATE', 'EDATE', 'JDATE', 'SDATE']
+DATETIME_FORMATS = ['DATETIME', 'YMDHMS']
+TIME_FORMATS = ['TIME', 'DTIME']
+
 global rootfolders
 
 rootfolders = [
@@ -63,23 +132,95 @@ rootfolders = [
 #
 # Functions
 #
-def getFiles(path, extension):
+#
+# List a directory with os.scandir: its subdirectories, and the files with their size and modification
+# time from the DirEntry, which on Windows costs no extra call to the (network) drive.
+#
+def scanDirectory(path, mtime):
     dirs = []
     files = []
-    scan = os.scandir(path)
-    
-    for entry in scan:
-        if entry.is_dir():
-            dirs.append(entry.name)
-        if entry.is_file() and entry.name.lower().endswith(extension): # also compares uppercase extensions
-            files.append(path + "\\" + entry.name)
-            
-    for dir in dirs:
-        for file in getFiles(path + "\\" + dir, extension):
-            files.append(file)
-    
+    with os.scandir(path) as scan:
+        for entry in scan:
+            if entry.is_dir():
+                dirs.append(entry.name)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append([entry.name, stat.st_size, stat.st_mtime])
+    return dict(mtime=mtime, dirs=dirs, files=files)
+
+# The listing of a directory, from the cached directories if its modification time did not change
+def getDirectory(path, cachedDirectories):
+    mtime = os.stat(path).st_mtime
+    cached = cachedDirectories.get(path)
+    if cached is not None and cached['mtime'] == mtime:
+        return cached
+    return scanDirectory(path, mtime)
+
+#
+# Walk the directory tree of path with a pool of threads, each scanning one directory. Adding or removing
+# files changes the modification time of their directory only, so every directory is visited, but only
+# the changed ones are listed again. The listings are added to directories, keyed by path.
+# Returns a sorted list of (file, size, mtime) of the files with the extension.
+#
+def walkFolder(path, extension, cachedDirectories, directories):
+    files = []
+
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as pool:
+        pending = {pool.submit(getDirectory, path, cachedDirectories): path}
+
+        while pending:
+            done, notDone = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                folder = pending.pop(future)
+                try:
+                    listing = future.result()
+                except OSError as ex:
+                    print(f"{folder} not accessible: {str(ex)}")
+                    continue
+
+                directories[folder] = listing
+
+                for name, size, mtime in listing['files']:
+                    if name.lower().endswith(extension): # also compares uppercase extensions
+                        files.append((folder + "\\" + name, size, mtime))
+
+                for dir in listing['dirs']:
+                    subfolder = folder + "\\" + dir
+                    pending[pool.submit(getDirectory, subfolder, cachedDirectories)] = subfolder
+
+    files.sort()
     return files
 
+def getFiles(path, extension):
+    return [file for file, size, mtime in walkFolder(path, extension, {}, {})]
+
+def readManifest(filename):
+    if not(os.path.exists(filename)):
+        return dict(directories={}, access={})
+    with open(filename, encoding="utf-8") as f:
+        return json.load(f)
+
+def writeManifest(filename, manifest):
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(filename + ".tmp", filename)
+    return
+
+# Check accessibility by opening the file, because could run into permission denied errno 13
+def checkAccess(file):
+    try:
+        g = open(file, 'r')
+        g.close()
+        return True, ''
+    except Exception as ex:
+        return False, str(ex)
+
+#
+# Write the accessible and non accessible files with the extension in the folders. The directories
+# and the access of the files are cached in MANIFEST_FILE, so a next run only lists the directories
+# which changed, and only opens the files which are new or changed.
+#
 def createFileOfExtensionFiles(folders, extension):
 
     numberOfFiles = 0
@@ -88,44 +229,60 @@ def createFileOfExtensionFiles(folders, extension):
     totalNumberOfAccessibleFiles = 0
     totalNumberOfNonAccessFiles = 0
 
+    manifest = readManifest(MANIFEST_FILE)
+    directories = {}
+    access = {}
+
+    begin = time.perf_counter()
+
     f = open('accessible_files_proposal.txt', 'w', encoding="utf-8")
     n = open('non_access_files_proposal.txt', 'w', encoding="utf-8")
 
     for folder in folders:
 
-        files = getFiles(folder, extension)
+        files = walkFolder(folder, extension, manifest['directories'], directories)
         numberOfFiles = len(files)
         
         numberOfCategories += 1
-        totalNumberOfFiles = totalNumberOfFiles + numberOfFiles  # numberOfFile has two values ?
+        totalNumberOfFiles = totalNumberOfFiles + numberOfFiles
 
         print(folder)
         print(numberOfFiles)
 
-        for file in files:
-            
-            print(file)
-            
-            try:
-                g = open(file, 'r')  # Check accessibility because could run into permission denied errno 13
-                g.close()
+        # Check the access of new and changed files only, in parallel
+        unchecked = [file for file, size, mtime in files if manifest['access'].get(file, [None, None])[:2] != [size, mtime]]
+        with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as pool:
+            checked = dict(zip(unchecked, pool.map(checkAccess, unchecked)))
+
+        for file, size, mtime in files:
 
+            if file in checked:
+                accessible, error = checked[file]
+                if not(accessible):
+                    print(f"{file} {error}")
+            else:
+                accessible = manifest['access'][file][2]
+
+            access[file] = [size, mtime, accessible]
+
+            if accessible:
                 f.write(file + '\n')
                 totalNumberOfAccessibleFiles += 1
-
-            except Exception as ex:
+            else:
                 n.write(file + '\n')
                 totalNumberOfNonAccessFiles += 1
-                print(ex)
 
     f.close()
     n.close()
 
+    writeManifest(MANIFEST_FILE, dict(directories=directories, access=access))
+
     print("\n")
     print(f"Total number of files:             {str(totalNumberOfFiles)}")
     print(f"Total number of accessible files:  {str(totalNumberOfAccessibleFiles)}")
     print(f"Total number of non access files:  {str(totalNumberOfNonAccessFiles)}")
     print(f"Total number of categories:        {str(numberOfCategories)}")
+    print(f"Seconds to find the files:         {time.perf_counter() - begin:.1f}")
 
     return
 
@@ -138,19 +295,6 @@ def numberOfFilesInFolder(folder, extension):
     files = getFiles(folder, extension)
     return len(files)
 
-# Search on root folder last chunk (index). Returns -1 if no chunk files created
-def lastChunknrCsvFile(table):
-    for chunknr in range(0,999):
-        if not(os.path.exists(f"{table}.{chunknr}")):
-            return chunknr - 1
-    return chunknr
-
-def removeChunkCsvFiles(table):
-    for chunknr in range(0,999):
-        if os.path.exists(f"{table}.{chunknr}"):
-            os.remove(f"{table}.{chunknr}")
-    return
-
 #
 # Examples of table name extraction from filename of sav file, versionname included
 #
@@ -184,6 +328,20 @@ def getTableNameFromFileName(file):
     # return upper case version
     return file.upper() + "_"
 
+#
+# Families of yearly and versioned files, by the name of their tables:
+# GBASCHEIDINGENMASSA2013V1_ -> family GBASCHEIDINGENMASSA, year 2013, version 1
+#
+FAMILY_PATTERN = re.compile(r"^(?P<family>[A-Z].*?)(?P<year>(19|20)\d\d)(V(?P<version>\d+))?_$")
+
+# The family, year and version of a table, None if its name has no year
+def getFamilyOfTableName(table):
+    match = FAMILY_PATTERN.match(table)
+    if match is None:
+        return None
+    version = int(match.group('version')) if match.group('version') else None
+    return SimpleNamespace(family=match.group('family'), year=int(match.group('year')), version=version)
+
 def readFiles(filename):
 
     # Converting the text file into a list of files
@@ -214,32 +372,421 @@ def createFileOfTableNames(fileList):
 
     return
 
+#
+# Read a sav-file in chunks of chunksize rows, starting at row offset, up to limit rows if given.
+# Yields (df, meta) per chunk, and stops at the first empty chunk.
+#
+# Note: this is not a single pass over the file. pyreadstat makes one read_sav call per chunk,
+# which opens the file and parses its dictionary again, and skips the rows before the offset
+# inside readstat without converting them into Python objects. For uncompressed files that is
+# a seek, but for row-compressed files, most CBS files, readstat decompresses all skipped rows,
+# so the time per chunk still grows with its offset, and the total quadratically with the
+# rows of the file (measured by benchmarkChunksOfSavFile of benchmark.py).
+# Its last chunk is not cut off at the limit, which is done here.
+#
+def readChunksOfSavFile(file, chunksize, offset=0, limit=0, **kwargs):
+    reader = sav.read_file_in_chunks(sav.read_sav, file, chunksize=chunksize, offset=offset, limit=limit, **kwargs)
+    remaining = limit
+    for df, meta in reader:
+        if df.shape[0] == 0:
+            break
+        if limit > 0:
+            if remaining <= 0:
+                break
+            if df.shape[0] > remaining:
+                df = df.iloc[:remaining]
+            remaining -= df.shape[0]
+        yield df, meta
+    return
+
+#
+# Estimate the bytes per row of a sav file in a dataframe, from a probe read of the first rows.
+# Strings and dates are Python objects, so this is a multiple of the row width in the file.
+# Without rows, the estimate is taken from the header: 8 bytes per number, an object per string.
+#
+def estimateRowSizeOfSavFile(file, nrProbeRows=1000):
+    df, meta = sav.read_sav(file, row_limit=nrProbeRows)
+
+    if df.shape[0] > 0:
+        return df.memory_usage(deep=True, index=False).sum() / df.shape[0]
+
+    rowSize = 0
+    for column in meta.column_names:
+        if meta.readstat_variable_types[column] == 'string':
+            width = re.sub(r"\D", "", meta.original_variable_types[column])
+            rowSize += 57 + (int(width) if width else 8)
+        else:
+            rowSize += 8
+
+    return rowSize
+
 def getColumnNames(file):
 
-    # read first row
-    df, meta = sav.read_sav(file, row_limit=1, row_offset=0)
+    meta = getMetaDataOfSavFile(file)
         
     columnNames = ""
     for name in meta.column_names:
         columnNames += name + "\n"
     
     return columnNames
+
+#
+# The fingerprint of a file: a sha1 hash of its size, its header, the last block and FINGERPRINT_BLOCKS blocks
+# spread over the file. It reads a few hundred kilobytes of any file, and tells a replaced file from a
+# file of which only the modification time changed. Small files are hashed as a whole.
+#
+def getFingerprintOfFile(file) -> str:
+    size = os.stat(file).st_size
+    fingerprint = hashlib.sha1(str(size).encode('ascii'))
+
+    with open(file, 'rb') as f:
+        if size <= (FINGERPRINT_BLOCKS + 2) * FINGERPRINT_BLOCK_BYTES:
+            fingerprint.update(f.read())
+            return fingerprint.hexdigest()
+
+        step = (size - FINGERPRINT_BLOCK_BYTES) // (FINGERPRINT_BLOCKS + 1)
+        for block in range(FINGERPRINT_BLOCKS + 2):
+            f.seek(block * step)
+            fingerprint.update(f.read(FINGERPRINT_BLOCK_BYTES))
+
+    return fingerprint.hexdigest()
     
 def getColumnTypes(file):
 
-    # read first row
-    df, meta = sav.read_sav(file, row_limit=1, row_offset=0)
+    meta = getMetaDataOfSavFile(file)
     
     columnTypes = ""
     keys = meta.original_variable_types.keys()
     for key in keys:
         columnTypes += meta.original_variable_types[key] + "\n"
 
+    return columnTypes
+
+#
+# Metadata catalog of the sav files
+#
+# The metadata of a sav file is read once with metadataonly=True, and stored in the SQLite
+# database METADATA_CATALOG with the size and modification time of the file. Until the file
+# changes, the metadata is taken from the catalog. The table variables holds one row per
+# variable, to query the catalog, for example for all files with a RINPERSOON variable.
+#
+def connectMetaDataCatalog():
+    catalog = sqlite3.connect(METADATA_CATALOG, timeout=60)
+    catalog.execute("CREATE TABLE IF NOT EXISTS savfiles (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, table_name TEXT, "
+                    "number_rows INTEGER, number_columns INTEGER, file_encoding TEXT, metadata TEXT)")
+    catalog.execute("CREATE TABLE IF NOT EXISTS variables (path TEXT, position INTEGER, name TEXT, label TEXT, "
+                    "original_type TEXT, readstat_type TEXT, sql_type TEXT, PRIMARY KEY (path, position))")
+    return catalog
+
+# Read the metadata of a sav file, as a dictionary which can be stored and passed between processes
+def readMetaDataOfSavFile(file) -> dict:
+    stat = os.stat(file)
+    df, meta = sav.read_sav(file, metadataonly=True)
+
+    return dict(
+        file=file,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        table_name=getTableNameFromFileName(file),
+        number_rows=meta.number_rows,
+        number_columns=meta.number_columns,
+        file_encoding=meta.file_encoding,
+        column_names=meta.column_names,
+        column_labels=meta.column_labels,
+        original_variable_types=meta.original_variable_types,
+        readstat_variable_types=meta.readstat_variable_types,
+        # JSON has string keys only, keep the codes of the value labels as pairs
+        variable_value_labels={column: [[code, label] for code, label in labels.items()] for column, labels in meta.variable_value_labels.items()},
+        missing_ranges=getattr(meta, 'missing_ranges', {}),
+        missing_user_values=getattr(meta, 'missing_user_values', {}),
+    )
+
+# The metadata as an object with the attributes of the metadata of pyreadstat
+def getMetaDataOfDict(metadata):
+    meta = SimpleNamespace(**metadata)
+    meta.variable_value_labels = {column: {code: label for code, label in labels} for column, labels in metadata['variable_value_labels'].items()}
+    meta.column_names_to_labels = dict(zip(meta.column_names, meta.column_labels))
+    return meta
+
+def storeMetaData(catalog, metadata):
+    path = metadata['file']
+    meta = getMetaDataOfDict(metadata)
+    sqlTypes = getSqlColumnTypes(meta)
+
+    catalog.execute("INSERT OR REPLACE INTO savfiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, metadata['size'], metadata['mtime'], metadata['table_name'], metadata['number_rows'],
+                     metadata['number_columns'], metadata['file_encoding'], json.dumps(metadata)))
+    catalog.execute("DELETE FROM variables WHERE path = ?", (path,))
+    catalog.executemany("INSERT INTO variables VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(path, position, column, meta.column_names_to_labels[column], meta.original_variable_types[column],
+                          meta.readstat_variable_types[column], sqlTypes[column]) for position, column in enumerate(meta.column_names)])
+    catalog.commit()
+    return
+
+def getCatalogedMetaData(catalog, file):
+    stat = os.stat(file)
+    row = catalog.execute("SELECT metadata FROM savfiles WHERE path = ? AND size = ? AND mtime = ?", (file, stat.st_size, stat.st_mtime)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+# The paths and table names of the cataloged sav files of a family of tables
+def getCatalogedFilesOfFamily(family) -> list:
+    catalog = connectMetaDataCatalog()
+    try:
+        rows = catalog.execute("SELECT path, table_name FROM savfiles").fetchall()
+    finally:
+        catalog.close()
+    return [[path, table] for path, table in rows
+            if getFamilyOfTableName(table) is not None and getFamilyOfTableName(table).family == family]
+
+# The metadata of a sav file, from the catalog, or read and added to the catalog if the file is new or changed
+def getMetaDataOfSavFile(file):
+    catalog = connectMetaDataCatalog()
+    try:
+        metadata = getCatalogedMetaData(catalog, file)
+        if metadata is None:
+            metadata = readMetaDataOfSavFile(file)
+            storeMetaData(catalog, metadata)
+    finally:
+        catalog.close()
+    return getMetaDataOfDict(metadata)
+
+# Add the new and changed sav files of the list to the catalog, reading their metadata in parallel
+def createMetaDataCatalog(fileList):
+    catalog = connectMetaDataCatalog()
+
+    unchanged = 0
+    changed = []
+    for file in fileList:
+        if getCatalogedMetaData(catalog, file) is None:
+            changed.append(file)
+        else:
+            unchanged += 1
+
+    print(f"Metadata of {unchanged} files in catalog, reading {len(changed)} new or changed files ...")
+
+    with ProcessPoolExecutor(max_workers=METADATA_WORKERS) as pool:
+        futures = {pool.submit(readMetaDataOfSavFile, file): file for file in changed}
+        for future in futures:
+            try:
+                storeMetaData(catalog, future.result())
+            except Exception as ex:
+                print(f"{futures[future]} metadata failed: {str(ex)}")
+
+    catalog.close()
     return
 
+#
+# Parquet cache of sav files
+#
+# A sav file is written once to a Parquet file on local disk while it is converted, with one row
+# group per conversion chunk. The name of the Parquet file contains a hash of the path, size and
+# modification time of the sav file, so a changed sav file is never read from an old copy. Next
+# loads and analyses read the Parquet file memory mapped, and only the columns they need.
+#
+def parquetAvailable() -> bool:
+    return pq is not None
+
+def getParquetCacheFile(file) -> str:
+    stat = os.stat(file)
+    key = hashlib.sha1(f"{file}|{stat.st_size}|{stat.st_mtime}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(PARQUET_CACHE_FOLDER, f"{getTableNameFromFileName(file)}{key}.parquet")
+
+def parquetCacheExists(file) -> bool:
+    return parquetAvailable() and os.path.exists(getParquetCacheFile(file))
+
+# The Arrow schema of a sav file, fixed from the metadata so that all chunks have the same schema
+def getParquetSchema(meta):
+    fields = []
+    for column, sqlType in getSqlColumnTypes(meta).items():
+        if meta.readstat_variable_types[column] == 'string':
+            fields.append(pa.field(column, pa.string()))
+        elif sqlType == 'DATE':
+            fields.append(pa.field(column, pa.date32()))
+        elif sqlType == 'DATETIME2':
+            fields.append(pa.field(column, pa.timestamp('ns')))
+        elif sqlType == 'TIME':
+            fields.append(pa.field(column, pa.time64('us')))
+        else:
+            fields.append(pa.field(column, pa.float64()))
+    return pa.schema(fields)
+
+#
+# Read a sav file in chunks like readChunksOfSavFile, and write each chunk as a row group to its
+# Parquet cache file. The cache file is complete only after the last chunk, until then it has a
+# temporary name. Only a read of the whole file, from offset 0, is cached.
+#
+def readChunksOfSavFileIntoCache(file, chunksize, meta):
+    cacheFile = getParquetCacheFile(file)
+    temporaryFile = cacheFile + f".{os.getpid()}.tmp"
+    os.makedirs(PARQUET_CACHE_FOLDER, exist_ok=True)
+
+    schema = getParquetSchema(meta)
+    writer = pq.ParquetWriter(temporaryFile, schema)
+    completed = False
+
+    try:
+        for df, chunkMeta in readChunksOfSavFile(file, chunksize):
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), row_group_size=df.shape[0])
+            yield df, chunkMeta
+        completed = True
+    finally:
+        writer.close()
+        if completed:
+            os.replace(temporaryFile, cacheFile)
+            evictParquetCache()
+        else:
+            os.remove(temporaryFile)
+
+    return
+
+#
+# Read the Parquet cache of a sav file in chunks of one row group, memory mapped, starting at row
+# offset, with only the given columns (all if None). Yields (df, meta) like readChunksOfSavFile.
+#
+def readChunksOfParquetCache(file, offset=0, columns=None):
+    cacheFile = getParquetCacheFile(file)
+    os.utime(cacheFile)  # the modification time marks the last use of the cache file
+
+    meta = getMetaDataOfSavFile(file)
+    parquet = pq.ParquetFile(cacheFile, memory_map=True)
+
+    start = 0
+    for group in range(parquet.num_row_groups):
+        nrRows = parquet.metadata.row_group(group).num_rows
+        if start + nrRows > offset:
+            df = parquet.read_row_group(group, columns=columns).to_pandas()
+            if offset > start:
+                df = df.iloc[offset - start:].reset_index(drop=True)
+            yield df, meta
+        start += nrRows
+
+    return
+
+# Read the Parquet cache of a sav file at once, for analysis, with only the given columns (all if None)
+def readParquetCache(file, columns=None):
+    cacheFile = getParquetCacheFile(file)
+    os.utime(cacheFile)
+    return pq.read_table(cacheFile, columns=columns, memory_map=True).to_pandas()
+
+# Remove the least recently used cache files until the cache fits in PARQUET_CACHE_BUDGET
+def evictParquetCache():
+    cacheFiles = [(os.stat(cacheFile).st_mtime, os.stat(cacheFile).st_size, cacheFile)
+                  for cacheFile in glob.glob(os.path.join(PARQUET_CACHE_FOLDER, "*.parquet"))]
+    cacheFiles.sort()
+
+    size = sum(cacheFileSize for mtime, cacheFileSize, cacheFile in cacheFiles)
+    for mtime, cacheFileSize, cacheFile in cacheFiles:
+        if size <= PARQUET_CACHE_BUDGET:
+            break
+        print(f"{cacheFile} removed from the Parquet cache")
+        os.remove(cacheFile)
+        size -= cacheFileSize
+
+    return
+
+#
+# Examples of SQL column types derived from the SPSS format of a variable
+#
+# 'F1.0' -> SMALLINT, 'F4.0' -> INT, 'F9.0' -> BIGINT, 'F15.0' -> BIGINT, 'F8.2' -> FLOAT
+# 'A2' -> CHAR(2), 'A40' -> VARCHAR(40), 'DATE11' -> DATE, 'DATETIME20' -> DATETIME2
+#
+# The width of an integer format only bounds the displayed digits, an F2.0 variable can hold
+# -1 or 100. The integer type is therefore one step wider than the width, and wide enough for
+# the value labels and missing values of the variable. Values which still do not fit widen the
+# column while converting, see castChunkToColumnTypes of database.py.
+#
+def getSqlColumnType(originalType, readstatType, codes=()):
+
+    match = re.match(r"^([A-Z]+)(\d*)(?:\.(\d+))?$", originalType.upper())
+    if match is None:
+        return 'VARCHAR(max)' if readstatType == 'string' else 'FLOAT'
+
+    format = match.group(1)
+    width = int(match.group(2)) if match.group(2) else 0
+    decimals = int(match.group(3)) if match.group(3) else 0
+
+    if readstatType == 'string':
+        if width == 0 or width > 8000:
+            return 'VARCHAR(max)'
+        if width <= FIXED_CHAR_WIDTH:
+            return f"CHAR({width})"
+        return f"VARCHAR({width})"
+
+    if format in DATE_FORMATS:
+        return 'DATE'
+    if format in DATETIME_FORMATS:
+        return 'DATETIME2'
+    if format in TIME_FORMATS:
+        return 'TIME'
+
+    if format in ['F', 'N', 'COMMA', 'DOT'] and decimals == 0 and 0 < width <= 18:
+        for typeName, maxWidth, low, high in INTEGER_FORMAT_TYPES:
+            if width <= maxWidth and all(code % 1 == 0 and low <= code <= high for code in codes):
+                return typeName
+
+    return 'FLOAT'
+
+# The order of the SQL integer types, from narrow to wide
+INTEGER_TYPES = ['TINYINT', 'SMALLINT', 'INT', 'BIGINT']
+
+# The integer types of integer formats: the largest width of the format, and the range of the type
+INTEGER_FORMAT_TYPES = [
+    ('SMALLINT', 2, -32768, 32767),
+    ('INT', 4, -2147483648, 2147483647),
+    ('BIGINT', 18, -9223372036854775808, 9223372036854775807),
+]
+
+# The width of a SQL string type, 0 for VARCHAR(max) and None for other types
+def getWidthOfSqlColumnType(columnType):
+    match = re.match(r"^(CHAR|VARCHAR)\((\d+|max)\)$", columnType)
+    if match is None:
+        return None
+    return 0 if match.group(2) == 'max' else int(match.group(2))
+
+#
+# The SQL column type holding the values of all given types, of a column in several files:
+# the widest integer, FLOAT for integers and floats, DATETIME2 for dates and datetimes,
+# the widest string, and otherwise a string wide enough for the values as text.
+#
+def getWidestSqlColumnType(columnTypes):
+    columnTypes = list(dict.fromkeys(columnTypes))
+    if len(columnTypes) == 1:
+        return columnTypes[0]
+
+    if all(columnType in INTEGER_TYPES for columnType in columnTypes):
+        return max(columnTypes, key=INTEGER_TYPES.index)
+    if all(columnType in INTEGER_TYPES + ['FLOAT'] for columnType in columnTypes):
+        return 'FLOAT'
+    if all(columnType in ['DATE', 'DATETIME2'] for columnType in columnTypes):
+        return 'DATETIME2'
+
+    widths = [getWidthOfSqlColumnType(columnType) for columnType in columnTypes]
+    if 0 in widths:
+        return 'VARCHAR(max)'
+    return f"VARCHAR({max([width for width in widths if width is not None] + [32])})"
+
+# The SQL column types of all variables of a sav file, from the metadata of pyreadstat
+def getSqlColumnTypes(meta) -> dict:
+
+    columnTypes = {}
+    for column in meta.column_names:
+
+        # Value labels and missing values show the codes used by a variable
+        codes = list(meta.variable_value_labels.get(column, {}).keys())
+        codes += list(getattr(meta, 'missing_user_values', {}).get(column, []))
+        for missingRange in getattr(meta, 'missing_ranges', {}).get(column, []):
+            codes += [missingRange['lo'], missingRange['hi']]
+        codes = [code for code in codes if isinstance(code, (int, float))]
+
+        columnTypes[column] = getSqlColumnType(meta.original_variable_types[column], meta.readstat_variable_types[column], codes)
+
+    return columnTypes
+
 def createMetaDataOfSavFiles(fileList):
 
-    nrFilesTooLargeForTransLog = 0
+    createMetaDataCatalog(fileList)
 
     f = open("metadata_proposal.txt", "w")
     for file in fileList:
@@ -247,42 +794,388 @@ def createMetaDataOfSavFiles(fileList):
         size = os.stat(file).st_size
         
         print(file + f" {size/1000000000} GB")
+
+        try:
+            meta = getMetaDataOfSavFile(file)
+        except Exception as ex:
+            print(f"{file} metadata failed: {str(ex)}")
+            continue
         
         f.write(f"{file} \n")
+        f.write(f"Table name: {meta.table_name}, rows: {meta.number_rows}\n")
         f.write(f"Field column names:\n")
-        f.write(f"{getColumnNames(file)} \n")
+        f.write("".join(name + "\n" for name in meta.column_names) + " \n")
         
         f.write(f"Field column types:\n")
-        f.write(f"{getColumnTypes(file)} \n")
+        f.write("".join(meta.original_variable_types[name] + "\n" for name in meta.column_names) + " \n")
 
     f.close()
 
+    createConversionSpecs(fileList)
+
     return
 
-def delimiterCsvFile(file):
-    f = open(file)
+#
+# Conversion specs
+#
+#   The file CONVERSION_SPECS lists the columns to keep and the row filters of files, by the name of a file
+#   or a pattern of file names. The first spec of which the pattern matches the file name, or its path, applies:
+#
+#   [{"pattern": "GBAPERSOON*.sav",
+#     "columns": ["RINPERSOONS", "RINPERSOON", "GBAGEBOORTEJAAR"],
+#     "filters": [["GBAGEBOORTEJAAR", ">=", 1950], ["GBAGESLACHT", "in", [1, 2]]]}]
+#
+#   Only the columns kept and the columns of the filters are read from the sav file, through usecols of
+#   pyreadstat. The filters select the rows of each chunk before it is inserted; rows pass if they pass all
+#   filters. A file without a spec is converted with all its columns and rows.
+#
 
-    if f.readline().find(',') > 0:
-        f.close()
-        return ','
+# The operators of the row filters, each giving the mask of the rows passing it
+FILTER_OPERATORS = {
+    '==': lambda values, value: values == value,
+    '!=': lambda values, value: values != value,
+    '<': lambda values, value: values < value,
+    '<=': lambda values, value: values <= value,
+    '>': lambda values, value: values > value,
+    '>=': lambda values, value: values >= value,
+    'in': lambda values, value: values.isin(value),
+    'not in': lambda values, value: ~values.isin(value),
+    'isnull': lambda values, value: values.isna(),
+    'notnull': lambda values, value: values.notna()
+}
 
-    if f.readline().find(';') > 0:
-        f.close()
-        return ';'
+# The specs read from CONVERSION_SPECS, with the modification time of the file
+conversionSpecs = None
+conversionSpecsMtime = None
 
-    f.close()
-    return ''
+def readConversionSpecs() -> list:
+    global conversionSpecs, conversionSpecsMtime
+
+    if not(os.path.exists(CONVERSION_SPECS)):
+        return []
+
+    mtime = os.stat(CONVERSION_SPECS).st_mtime
+    if conversionSpecs is None or mtime != conversionSpecsMtime:
+        with open(CONVERSION_SPECS, 'r') as f:
+            specs = json.load(f)
+        for spec in specs:
+            for column, operator, *value in spec.get('filters', []):
+                if operator not in FILTER_OPERATORS:
+                    raise ValueError(f"{CONVERSION_SPECS}: unknown operator {operator} in filter of {column}")
+        conversionSpecs = specs
+        conversionSpecsMtime = mtime
+
+    return conversionSpecs
+
+# The spec of a file, None if no spec matches its name or path
+def getConversionSpec(file):
+    name = re.split(r'[\\/]', file)[-1].lower()
+    for spec in readConversionSpecs():
+        pattern = spec['pattern'].lower()
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(file.lower(), pattern):
+            return spec
+    return None
+
+# The columns of the file kept by the spec, in the order of the file
+def getColumnsOfConversionSpec(spec, meta) -> list:
+    if spec is None or not(spec.get('columns')):
+        return list(meta.column_names)
+
+    unknown = [column for column in spec['columns'] if column not in meta.column_names]
+    if len(unknown) > 0:
+        raise ValueError(f"Columns {', '.join(unknown)} of conversion spec {spec['pattern']} not in {meta.file}")
+
+    return [column for column in meta.column_names if column in spec['columns']]
+
+# The columns read from the file for the spec: the columns kept and the columns of its filters. None for all.
+def getReadColumnsOfConversionSpec(spec, meta):
+    if spec is None or not(spec.get('columns')):
+        return None
+
+    columns = set(getColumnsOfConversionSpec(spec, meta))
+    columns.update(filter[0] for filter in spec.get('filters', []))
+    return [column for column in meta.column_names if column in columns]
+
+# The rows of a chunk passing the filters of the spec, with only the columns kept
+def applyConversionSpec(df, spec):
+    if spec is None:
+        return df
+
+    filters = spec.get('filters', [])
+    if len(filters) > 0:
+        mask = pd.Series(True, index=df.index)
+        for column, operator, *value in filters:
+            mask &= FILTER_OPERATORS[operator](df[column], value[0] if value else None).fillna(False).astype(bool)
+        df = df[mask.values].reset_index(drop=True)
+
+    if spec.get('columns'):
+        df = df[[column for column in df.columns if column in spec['columns']]]
+
+    return df
+
+# Write a starting spec of each file, with all its columns and no filters, to be trimmed and renamed to CONVERSION_SPECS
+def createConversionSpecs(fileList, specFile='conversion_specs_proposal.json'):
+    specs = []
+    for file in fileList:
+        try:
+            meta = getMetaDataOfSavFile(file)
+        except Exception as ex:
+            print(f"{file} metadata failed: {str(ex)}")
+            continue
+
+        specs.append(dict(pattern=re.split(r'[\\/]', file)[-1], columns=list(meta.column_names), filters=[]))
+
+    with open(specFile, 'w') as f:
+        json.dump(specs, f, indent=2)
+
+    print(f"Conversion specs of {len(specs)} files written to {specFile}")
+    return
+
+#
+# Sniffing of csv files
+#
+
+# The dialect and schema of the csv files sniffed before, keyed by path, size and mtime
+sniffedCsvFiles = {}
+
+# The position after the first complete record of a block of a csv file, a newline outside quotes. 0 if none.
+def firstRecordEnd(block, quotechar=b'"'):
+    position = block.find(b'\n')
+    while position >= 0:
+        if block.count(quotechar, 0, position) % 2 == 0:
+            return position + 1
+        position = block.find(b'\n', position + 1)
+    return 0
+
+# The position after the last complete record of a block of a csv file, a newline outside quotes. 0 if none.
+def lastRecordEnd(block, quotechar=b'"'):
+    position = block.rfind(b'\n')
+    while position >= 0:
+        if block.count(quotechar, 0, position) % 2 == 0:
+            return position + 1
+        position = block.rfind(b'\n', 0, position)
+    return 0
+
+# The encoding of a sample of a csv file: utf-8 with or without byte order mark, otherwise cp1252
+def getEncodingOfCsvSample(sample):
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+# The smallest integer type of which the range covers the values found times the headroom
+def getCsvIntegerType(bound, headroom):
+    for typeName, maximum in [('SMALLINT', 32767), ('INT', 2147483647), ('BIGINT', 9223372036854775807)]:
+        if bound * headroom <= maximum:
+            return typeName
+    return 'BIGINT' if bound <= 9223372036854775807 else None
+
+#
+# The SQL column types of the columns of a sample of a csv file, parsed as strings and parsed with the type
+# inference of the C engine. The remaining checks run once over the values of the candidate columns instead
+# of per column, a wide file has thousands of columns. If the sample does not cover the whole file, integers
+# and strings get headroom above the values found. A later value out of range widens the column while
+# converting, see castChunkToColumnTypes of database.py.
+#
+def getCsvColumnTypes(strings, inferred, complete) -> dict:
+    headroom = 1 if complete else CSV_TYPE_HEADROOM
+
+    values = strings.stack()
+    columns = values.index.get_level_values(1)
+
+    def valuesOfColumns(selected):
+        mask = columns.isin(selected)
+        return values[mask], columns[mask]
+
+    def allOfColumns(selected, pattern):
+        selectedValues, selectedColumns = valuesOfColumns(selected)
+        return selectedValues.str.fullmatch(pattern).groupby(selectedColumns).all()
+
+    def validDatesOfColumns(selected, format):
+        selectedValues, selectedColumns = valuesOfColumns(selected)
+        return pd.to_datetime(selectedValues, format=format, errors='coerce').notna().groupby(selectedColumns).all()
+
+    numericColumns = [column for column in strings.columns if inferred[column].dtype.kind in 'iuf']
+    floatColumns = [column for column in numericColumns if inferred[column].dtype.kind == 'f']
+
+    # Codes with leading zeros, like postal codes and identifiers, stay strings
+    numericValues, numericColumnsOfValues = valuesOfColumns(numericColumns)
+    leadingZeros = numericValues.str.match(r'[-+]?0\d').groupby(numericColumnsOfValues).any()
+    integers = allOfColumns(floatColumns, r'[-+]?\d{1,18}')
+
+    # Only columns of which the first value looks like a date are checked on all values
+    firstValues = values.groupby(columns).first()
+    dateColumns = [column for column in firstValues.index if column not in numericColumns and re.fullmatch(r'\d{4}-\d{2}-\d{2}', firstValues[column])]
+    datetimeColumns = [column for column in firstValues.index if column not in numericColumns and re.fullmatch(r'\d{4}-\d{2}-\d{2}[ T].*', firstValues[column])]
+    dates = allOfColumns(dateColumns, r'\d{4}-\d{2}-\d{2}') & validDatesOfColumns(dateColumns, '%Y-%m-%d')
+    datetimes = allOfColumns(datetimeColumns, r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?') & validDatesOfColumns(datetimeColumns, None)
+
+    lengths = values.str.len().groupby(columns)
+    maxLengths = lengths.max()
+    minLengths = lengths.min()
+
+    columnTypes = {}
+    for column in strings.columns:
+        if column not in firstValues.index:
+            columnTypes[column] = 'VARCHAR(max)'
+            continue
+
+        if column in numericColumns and not(leadingZeros.get(column, False)):
+            if column not in floatColumns or integers.get(column, False):
+                typeName = getCsvIntegerType(inferred[column].abs().max(), headroom)
+                if typeName is not None:
+                    columnTypes[column] = typeName
+                    continue
+            columnTypes[column] = 'FLOAT'
+            continue
+
+        if dates.get(column, False):
+            columnTypes[column] = 'DATE'
+            continue
+        if datetimes.get(column, False):
+            columnTypes[column] = 'DATETIME2'
+            continue
+
+        width = int(maxLengths[column])
+        if complete and width <= FIXED_CHAR_WIDTH and minLengths[column] == width:
+            columnTypes[column] = f"CHAR({width})"
+            continue
+
+        width = max(16, width if complete else 2 * width)
+        columnTypes[column] = 'VARCHAR(max)' if width > 8000 else f"VARCHAR({width})"
+
+    return columnTypes
+
+# The pandas dtype in which the parser reads a column of a SQL column type, None for dates. Integers are read
+#   as Int64 whatever their type, so a later value out of range of the type is kept to widen the column.
+def getDtypeOfCsvColumnType(typeName):
+    if typeName in ['SMALLINT', 'INT', 'BIGINT']:
+        return 'Int64'
+    if typeName == 'FLOAT':
+        return 'float64'
+    if typeName in ['DATE', 'DATETIME2']:
+        return None
+    return str
+
+#
+# Sniff the dialect and schema of a csv file from one sample of CSV_SAMPLE_BYTES at the start of the file:
+# the encoding, delimiter, quoting, header, the byte offset of the data and the SQL column types and
+# pandas dtypes of the columns. A first record with a number in it is taken as data instead of a header.
+#
+def sniffCsvFile(file):
+    status = os.stat(file)
+    key = (file, status.st_size, status.st_mtime)
+    if key in sniffedCsvFiles:
+        return sniffedCsvFiles[key]
+
+    with open(file, 'rb') as f:
+        sample = f.read(CSV_SAMPLE_BYTES)
+        complete = f.read(1) == b''
+
+    # An incomplete sample is cut after its last line, not in the middle of a character
+    if not(complete) and sample.rfind(b'\n') > 0:
+        sample = sample[:sample.rfind(b'\n') + 1]
+
+    encoding = getEncodingOfCsvSample(sample)
+    text = sample.decode(encoding, errors='replace')
+
+    lines = text.splitlines()
+    firstLine = lines[0] if lines else ''
+    try:
+        sniffText = text[:65536]
+        if len(text) > 65536 and sniffText.rfind('\n') > 0:
+            sniffText = sniffText[:sniffText.rfind('\n')]
+        dialect = csv.Sniffer().sniff(sniffText, delimiters=CSV_DELIMITERS)
+        delimiter, quotechar, doublequote = dialect.delimiter, dialect.quotechar, dialect.doublequote
+    except csv.Error:
+        delimiter = max(CSV_DELIMITERS, key=firstLine.count)
+        quotechar, doublequote = '"', True
+
+    quotebytes = quotechar.encode('latin-1')
+    bomLength = len(codecs.BOM_UTF8) if encoding == 'utf-8-sig' else 0
+
+    firstRecord = next(csv.reader([firstLine], delimiter=delimiter, quotechar=quotechar, doublequote=doublequote), [])
+    header = not(any(re.fullmatch(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*', field) for field in firstRecord))
+
+    if header:
+        columns = [field.strip() for field in firstRecord]
+        dataOffset = firstRecordEnd(sample, quotebytes) or len(sample)
+    else:
+        columns = [f"COLUMN{index + 1}" for index in range(len(firstRecord))]
+        dataOffset = bomLength
+
+    # The sample is parsed as strings and with the type inference of the C engine, the column types are inferred of both
+    data = sample[dataOffset:].decode(encoding, errors='replace')
+    parse = dict(sep=delimiter, quotechar=quotechar, doublequote=doublequote, header=None, names=columns, engine='c')
+    df = pd.read_csv(io.StringIO(data), dtype=str, **parse)
+
+    columnTypes = getCsvColumnTypes(df, pd.read_csv(io.StringIO(data), **parse), complete)
+    dtypes = {column: getDtypeOfCsvColumnType(typeName) for column, typeName in columnTypes.items()}
+
+    csvFile = SimpleNamespace(file=file, encoding=encoding, delimiter=delimiter, quotechar=quotechar, doublequote=doublequote,
+                              header=header, dataOffset=dataOffset, columns=columns, columnTypes=columnTypes,
+                              dtypes={column: dtype for column, dtype in dtypes.items() if dtype is not None},
+                              parseDates=[column for column, dtype in dtypes.items() if dtype is None],
+                              sampledRows=df.shape[0], complete=complete)
+
+    sniffedCsvFiles[key] = csvFile
+    return csvFile
+
+#
+# Read a csv file in chunks of about CSV_CHUNK_BYTES, starting at byteOffset (0 is the start of the data,
+# after the header). Each block is cut after its last complete record and parsed with the C engine in the
+# dialect and dtypes sniffed by sniffCsvFile. Yields (df, byteEnd) per chunk, byteEnd is the position in the
+# file after the chunk.
+#
+def readChunksOfCsvFile(file, byteOffset=0):
+    csvFile = sniffCsvFile(file)
+    quotebytes = csvFile.quotechar.encode('latin-1')
+
+    with open(file, 'rb') as f:
+        position = max(byteOffset, csvFile.dataOffset)
+        f.seek(position)
+
+        remainder = b''
+        while True:
+            block = f.read(CSV_CHUNK_BYTES)
+            data = remainder + block
+
+            # A block without a complete record is read on together with the next block
+            if block:
+                end = lastRecordEnd(data, quotebytes)
+                if end == 0:
+                    remainder = data
+                    continue
+            else:
+                end = len(data)
+
+            if data[:end].strip():
+                df = pd.read_csv(io.BytesIO(data[:end]), sep=csvFile.delimiter, quotechar=csvFile.quotechar,
+                                 doublequote=csvFile.doublequote, encoding=csvFile.encoding, header=None,
+                                 names=csvFile.columns, dtype=csvFile.dtypes, parse_dates=csvFile.parseDates, engine='c')
+                yield df, position + end
+
+            if not block:
+                break
+
+            position += end
+            remainder = data[end:]
+
+    return
+
+def delimiterCsvFile(file):
+    return sniffCsvFile(file).delimiter
 
 def columnsCsvFile(file):
-    f = open(file)
-    header = f.readline().split(delimiterCsvFile(file))
-    f.close()
-    columns = []
-    for index in range(len(header)):
-        st1 = header[index].replace('"','')
-        st2 = st1.replace('\n','')
-        columns.append(st2)
-    return columns
+    return sniffCsvFile(file).columns
 
 #
 # Call of functions